@@ -35,60 +35,135 @@ Implementation Notes
 * Adafruit CircuitPython Logging Module:
   https://github.com/adafruit/Adafruit_CircuitPython_Logging
 
+* Adafruit CircuitPython RSA Module:
+  https://github.com/adafruit/Adafruit_CircuitPython_RSA
+
 """
 # Core CircuitPython modules
-import gc
+import json
+import random
 import time
-import rtc
-
-import adafruit_logging as logging
-from adafruit_jwt import JWT
 
+# rtc, adafruit_logging, adafruit_jwt and adafruit_rsa are imported where
+# they are first used, as are this library's optional feature modules, so a
+# device only pays for the parts it uses:
+#
+# * adafruit_iotcore_codec: CBOR_Codec, Struct_Codec, Buffer_Pool, Deflate_Compressor
+# * adafruit_iotcore_queue: Token_Bucket, Rate_Limiter, Outbox, Priority_Scheduler
+# * adafruit_iotcore_routing: Command_Router, Gateway, Duplicate_Filter, Device_Config
+# * adafruit_iotcore_telemetry: Histogram, Metrics, Batch_Publisher, Window_Aggregator
+# * adafruit_iotcore_time: Strftime_Time_Source, SNTP_Time_Source, HTTP_Date_Time_Source,
+#   Time_Sync
+# * adafruit_iotcore_packet: MQTT packet encoding, used for binary payloads
 
 __version__ = "0.0.0-auto.0"
 __repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_Cloud_IOT_Core.git"
 
-TIME_SERVICE = (
-    "https://io.adafruit.com/api/v2/%s/integrations/time/strftime?x-aio-key=%s"
-)
+# Hash method used by adafruit_rsa for each supported RSA JWT algorithm
+RSA_HASH_METHODS = {"RS256": "SHA-256", "RS384": "SHA-384", "RS512": "SHA-512"}
+
+# CONNACK return codes for rejected credentials: bad username or password, not authorized
+MQTT_AUTH_FAILURES = (4, 5)
 
-# our strftime is %Y-%m-%d %H:%M:%S.%L %j %u %z %Z see http://strftime.net/ for decoding details
-# See https://apidock.com/ruby/DateTime/strftime for full options
-TIME_SERVICE_STRFTIME = (
-    "&fmt=%25Y-%25m-%25d+%25H%3A%25M%3A%25S.%25L+%25j+%25u+%25z+%25Z"
-)
+# Lower case text of MiniMQTT's exceptions for a lost, refused or failed connection
+MQTT_CONNECTION_ERRORS = ("connect", "broker", "pingresp")
+
+# Lower case text of ESP32SPI's RuntimeErrors for a failed connection, lookup or send
+ESP32SPI_CONNECTION_ERRORS = ("connect", "hostname", "send", "socket", "timed out", "esp32")
+
+if hasattr(time, "monotonic_ns"):
+    def _ticks_us():
+        """Returns the monotonic clock in microseconds."""
+        return time.monotonic_ns() // 1000 # pylint: disable=no-member
+else:
+    def _ticks_us():
+        """Returns the monotonic clock in microseconds."""
+        return int(time.monotonic() * 1000000)
 
 class MQTT_API_ERROR(Exception):
     """Exception raised on MQTT API return-code errors."""
     # pylint: disable=unnecessary-pass
     pass
 
+def _is_connection_error(error):
+    """Returns True if error was raised by a lost or refused MQTT connection, rather
+    than by a message which would fail again if it was sent again.
+    """
+    if isinstance(error, (OSError, MQTT_API_ERROR)):
+        return True
+    # MiniMQTT raises its own exception type, which isn't imported here, for
+    # invalid messages as well as connection errors
+    if "MMQTTException" in str(type(error)):
+        fragments = MQTT_CONNECTION_ERRORS
+    elif isinstance(error, RuntimeError):
+        # ESP32SPI's sockets raise RuntimeError, such as "Failed to connect to host"
+        fragments = ESP32SPI_CONNECTION_ERRORS
+    else:
+        return False
+    message = str(error).lower()
+    for fragment in fragments:
+        if fragment in message:
+            return True
+    return False
+
+def _is_auth_failure(error):
+    """Returns True if error was raised by the broker rejecting the client's credentials.
+    """
+    if isinstance(error, MQTT_API_ERROR):
+        return error.args[0] in MQTT_AUTH_FAILURES
+    if getattr(error, "code", None) in MQTT_AUTH_FAILURES:
+        return True
+    # Older MiniMQTT releases only give the CONNACK error's text
+    message = str(error)
+    return "username/password" in message or "Unauthorized" in message
+
+# pylint: disable=too-many-instance-attributes
 class MQTT_API:
     """Client for interacting with Google's Cloud Core MQTT API.
 
     :param MiniMQTT mqtt_client: MiniMQTT Client object.
+    :param Cloud_Core cloud_core: Optional Cloud_Core object. If provided, the client's
+        password is taken from Cloud_Core's cached JWT and refreshed before it expires.
+    :param bool validate: Checks the client and its JWT, defaults to True. Devices
+        waking from deep sleep with a known good client and pre-provisioned JWT can
+        pass False to skip the checks, and importing adafruit_jwt.
     """
 
-    # pylint: disable=protected-access
-    def __init__(self, mqtt_client):
+    __slots__ = (
+        "_client", "_user", "_cloud_core", "_logger", "_connected", "_prefix", "_topics",
+        "_writer", "_state", "_state_hash", "_state_time", "_pending_state", "_resync",
+        "_subscriptions", "_disconnected_at", "_retry_at", "device_id", "topic_cache_size",
+        "on_connect", "on_disconnect", "on_message", "on_subscribe", "on_unsubscribe",
+        "on_publish", "on_config", "router", "gateway", "config", "outbox", "codec",
+        "compressor", "rate_limiter", "state_interval", "states_suppressed", "metrics",
+        "backoff", "reconnects", "reconnect_failures", "auth_failures", "downtime",
+        "max_downtime", "scheduler", "duplicate_filter",
+    )
+
+    # pylint: disable=protected-access, too-many-statements
+    def __init__(self, mqtt_client, cloud_core=None, validate=True):
         # Check that provided object is a MiniMQTT client object
-        mqtt_client_type = str(type(mqtt_client))
-        if "MQTT" in mqtt_client_type:
-            self._client = mqtt_client
-        else:
+        if validate and "MQTT" not in str(type(mqtt_client)):
             raise TypeError(
                 "This class requires a MiniMQTT client object, please create one."
             )
+        self._client = mqtt_client
         # Verify that the MiniMQTT client was setup correctly.
         try:
             self._user = self._client._user
         except:
             raise TypeError("Google Cloud Core IoT MQTT API requires a username.")
-        # Validate provided JWT before connecting
-        try:
-            JWT.validate(self._client._pass)
-        except:
-            raise TypeError("Invalid JWT provided.")
+        # Use Cloud_Core's cached JWT as the client password
+        self._cloud_core = cloud_core
+        if self._cloud_core is not None:
+            self._client._pass = self._cloud_core.jwt
+        elif validate:
+            # Validate provided JWT before connecting, Cloud_Core's are generated here
+            from adafruit_jwt import JWT
+            try:
+                JWT.validate(self._client._pass)
+            except:
+                raise TypeError("Invalid JWT provided.")
         # If client has KeepAlive =0 or if KeepAlive > 20min,
         # set KeepAlive to 19 minutes to avoid disconnection
         # due to Idle Time (https://cloud.google.com/iot/quotas).
@@ -100,10 +175,12 @@ class MQTT_API:
         self.on_message = None
         self.on_subscribe = None
         self.on_unsubscribe = None
+        self.on_publish = None
         # MQTT event callbacks
         self._client.on_connect = self._on_connect_mqtt
         self._client.on_disconnect = self._on_disconnect_mqtt
         self._client.on_message = self._on_message_mqtt
+        self._client.on_publish = self._on_publish_mqtt
         self._logger = False
         if self._client._logger is not None:
             # Allow IOTCore to share MiniMQTT Client's logger
@@ -112,6 +189,53 @@ class MQTT_API:
         self._connected = False
         # Set up a device identifier by splitting out the full CID
         self.device_id = self._client._client_id.split("/")[7]
+        # Full MQTT topics keyed by topic or (topic, subfolder), see _topic
+        self._prefix = "/devices/{}/".format(self.device_id)
+        self._topics = {}
+        self.topic_cache_size = 16
+        # Writes binary payloads, see _publish
+        self._writer = None
+        # Inbound message handlers, see add_route
+        self.router = None
+        # Set by a Gateway using this client, see Gateway
+        self.gateway = None
+        # Optional cached device configuration, see Device_Config
+        self.config = None
+        self.on_config = None
+        # Optional store-and-forward queue, see Outbox
+        self.outbox = None
+        # Optional payload codec, such as CBOR_Codec or Struct_Codec
+        self.codec = None
+        # Optional compression for large events, see Deflate_Compressor
+        self.compressor = None
+        # Optional publish rate limits, see Rate_Limiter
+        self.rate_limiter = None
+        # Optional priority queues for outbound messages, see Priority_Scheduler
+        self.scheduler = None
+        # Optional suppression of redelivered inbound messages, see Duplicate_Filter
+        self.duplicate_filter = None
+        # Last published and pending device state, see publish_state
+        self.state_interval = 1
+        self.states_suppressed = 0
+        self._state = None
+        self._state_hash = None
+        self._state_time = None
+        self._pending_state = None
+        # Optional counters and latency histograms, see Metrics
+        self.metrics = None
+        # Active subscriptions, as qos keyed by full MQTT topic, renewed on reconnect
+        self._subscriptions = {}
+        # Reconnection by supervise, see Backoff
+        self.backoff = Backoff()
+        self.reconnects = 0
+        self.reconnect_failures = 0
+        self.auth_failures = 0
+        self.downtime = 0
+        self.max_downtime = 0
+        self._disconnected_at = None
+        self._retry_at = 0
+        # Set when the broker rejects the JWT, to sync the time before the next attempt
+        self._resync = False
 
     def __enter__(self):
         return self
@@ -133,12 +257,16 @@ class MQTT_API:
         self.on_message = None
         self.on_subscribe = None
         self.on_unsubscribe = None
+        self.on_config = None
         # De-initialize MiniMQTT Client
         self._client.deinit()
 
     def connect(self):
         """Connects to the Google MQTT Broker.
         """
+        if self._cloud_core is not None:
+            # Hand the client a JWT which is still valid, normally a cached one
+            self._client._pass = self._cloud_core.jwt
         self._client.connect()
         self._connected = True
 
@@ -158,6 +286,10 @@ class MQTT_API:
             self._connected = True
         else:
             raise MQTT_API_ERROR(return_code)
+        if self.metrics is not None:
+            self.metrics.connects += 1
+        if self.gateway is not None:
+            self.gateway.reset()
         # Call the user-defined on_connect callback if defined
         if self.on_connect is not None:
             self.on_connect(self, userdata, flags, return_code)
@@ -168,20 +300,81 @@ class MQTT_API:
         """
         if self._logger:
             self._client._logger.debug("Client called on_disconnect")
-        self._connected = False
+        self._connection_lost()
         # Call the user-defined on_disconnect callblack if defined
         if self.on_disconnect is not None:
             self.on_disconnect(self)
 
-    # pylint: disable=not-callable
+    # pylint: disable=not-callable, unused-argument
+    def _on_publish_mqtt(self, client, userdata, topic, pid):
+        """Runs when the client calls on_publish.
+        """
+        if self.on_publish is not None:
+            self.on_publish(self, userdata, topic, pid)
+
     def _on_message_mqtt(self, client, topic, payload):
         """Runs when the client calls on_message
         """
         if self._logger:
             self._client._logger.debug("Client called on_message")
+        if self.duplicate_filter is not None and self.duplicate_filter.seen(topic, payload):
+            return
+        if self.metrics is None:
+            self._dispatch(topic, payload)
+        else:
+            start = _ticks_us()
+            self._dispatch(topic, payload)
+            self.metrics.dispatch_time.record(_ticks_us() - start)
+
+    # pylint: disable=not-callable
+    def _dispatch(self, topic, payload):
+        """Passes an inbound message to config, its route, the gateway or on_message.
+        Configuration messages are applied to config, if set, calling on_config
+        when the configuration changes.
+        """
+        if topic.startswith(self._prefix):
+            device_topic = topic[len(self._prefix):]
+            if device_topic == "config" and self.config is not None:
+                if self.config.update(payload) and self.on_config is not None:
+                    self.on_config(self, self.config)
+                return
+            if self.router is not None and self.router.dispatch(self, topic, payload,
+                                                                device_topic):
+                return
+        elif self.gateway is not None and self.gateway.dispatch(topic, payload):
+            return
         if self.on_message is not None:
             self.on_message(self, topic, payload)
 
+    def add_route(self, pattern, handler):
+        """Calls handler for messages to a device topic pattern, instead of on_message.
+
+        :param str pattern: Topic, relative to the device, which may contain the
+            MQTT wildcards + and #, such as "config" or "commands/#".
+        :param handler: Function called with (mqtt_api, topic, payload).
+
+        Example of handling a command:
+        ..code-block:: python
+
+            def reboot(client, topic, payload):
+                microcontroller.reset()
+
+            google_mqtt.add_route("commands/reboot", reboot)
+            google_mqtt.subscribe_to_all_commands()
+
+        """
+        if self.router is None:
+            # pylint: disable=cyclic-import
+            from adafruit_iotcore_routing import Command_Router
+            self.router = Command_Router()
+        self.router.add(pattern, handler)
+
+    def remove_route(self, pattern, handler=None):
+        """Removes a handler, or all handlers if handler is None, from a device topic pattern.
+        """
+        if self.router is not None:
+            self.router.remove(pattern, handler)
+
     def loop(self):
         """Maintains a connection with Google Cloud IoT Core's MQTT broker. You will
         need to manually call this method within a loop to retain connection.
@@ -193,14 +386,140 @@ class MQTT_API:
                 google_iot.loop()
 
         """
+        metrics = self.metrics
+        if metrics is not None:
+            start = _ticks_us()
         if self._connected:
             self._client.loop()
+            if self.outbox:
+                self.outbox.drain(self._publish, limiter=self.rate_limiter)
+            if self.scheduler is not None:
+                self.scheduler.drain(self._publish, self.rate_limiter)
+            if self._pending_state is not None and (
+                    self._state_time is None
+                    or time.monotonic() - self._state_time >= self.state_interval):
+                self._send_state(self._pending_state, hash(self._pending_state))
+        if self._cloud_core is not None and self._cloud_core.jwt_expiring:
+            # Mint the next JWT ahead of time so a reconnect doesn't have to
+            self._client._pass = self._cloud_core.jwt
+        if metrics is not None:
+            metrics.loop_time.record(_ticks_us() - start)
+            if self._connected and metrics.due:
+                self.publish_metrics()
+
+    def publish_metrics(self):
+        """Publishes a snapshot of metrics to the "events/metrics" topic, JSON
+        encoded unless the codec encodes dicts. Metrics aren't published as the
+        device state, so they can't replace a state update held back by publish_state.
+        """
+        if self._cloud_core is not None:
+            self.metrics.jwt_refreshes = self._cloud_core.jwt_refreshes
+        snapshot = self.metrics.snapshot(self._prefix)
+        if self.scheduler is not None:
+            snapshot["queues"] = self.scheduler.snapshot()
+        if self.duplicate_filter is not None:
+            snapshot["duplicates"] = [self.duplicate_filter.checks, self.duplicate_filter.hits]
+        return self.publish(_encode_dict(self.codec, snapshot), subfolder="metrics",
+                            encode=False)
 
     def loop_blocking(self):
         """Begins a blocking loop to process messages from
-        IoT Core. Code below a call to this method will NOT run.
+        IoT Core, reconnecting whenever the connection is lost (see supervise).
+        Code below a call to this method will NOT run.
+        """
+        while True:
+            if not self.supervise():
+                time.sleep(max(self._retry_at - time.monotonic(), 0))
+
+    def supervise(self):
+        """Calls loop() while connected. Once the connection is lost, connects
+        again after a delay from backoff, with random jitter so that devices
+        disconnected together don't all reconnect together. Connection errors,
+        including ESP32SPI's RuntimeErrors for a failed connection or DNS lookup,
+        are counted rather than raised. Returns True if connected.
+
+        If the broker rejects the client's JWT, the time is synced again and a new
+        JWT generated before the next attempt, and if that fails it is tried again
+        after the next delay. After reconnecting, the client subscribes
+        again to each topic it was subscribed to.
+
+        Example of a main loop which keeps its connection:
+        ..code-block:: python
+
+            while True:
+                google_mqtt.supervise()
+                read_sensors()
+
         """
-        self._client.loop_forever()
+        if self._connected:
+            try:
+                self.loop()
+            except Exception as error: # pylint: disable=broad-except
+                if not _is_connection_error(error):
+                    raise
+                self._connection_lost()
+            return self._connected
+        if self._disconnected_at is None:
+            self._connection_lost()
+        if time.monotonic() < self._retry_at:
+            return False
+        try:
+            if self._resync:
+                # The JWT may have been rejected for being issued by a drifted clock
+                self._cloud_core.time_sync.sync()
+                self._cloud_core.generate_jwt(self._cloud_core.jwt_ttl, self._cloud_core.jwt_algo)
+                self._resync = False
+            self.connect()
+        except Exception as error: # pylint: disable=broad-except
+            if not _is_connection_error(error):
+                raise
+            self._connected = False
+            self.reconnect_failures += 1
+            self._retry_at = time.monotonic() + self.backoff.next_delay()
+            if self._cloud_core is not None and _is_auth_failure(error):
+                self.auth_failures += 1
+                self._resync = True
+            return False
+        for mqtt_topic, qos in self._subscriptions.items():
+            self._client.subscribe(mqtt_topic, qos)
+        self.backoff.reset()
+        self.reconnects += 1
+        self.downtime = time.monotonic() - self._disconnected_at
+        self.max_downtime = max(self.max_downtime, self.downtime)
+        self._disconnected_at = None
+        return True
+
+    def _connection_lost(self):
+        """Marks the client as disconnected, starting the backoff before a reconnect.
+        """
+        self._connected = False
+        if self._disconnected_at is None:
+            self._disconnected_at = time.monotonic()
+            self._retry_at = self._disconnected_at + self.backoff.next_delay()
+
+    def _topic(self, topic, subfolder=None):
+        """Returns the full MQTT topic for a device topic and optional subfolder.
+        Topics are formatted the first time they are used and cached, and the
+        cache is cleared once topic_cache_size topics are cached. Dicts aren't
+        ordered on CircuitPython, so there is no oldest topic to evict.
+        :param str topic: Required MQTT topic.
+        :param str subfolder: Optional MQTT topic subfolder. Defaults to None.
+        """
+        # Keyed by topic alone when possible, building a tuple allocates
+        key = topic if subfolder is None else (topic, subfolder)
+        mqtt_topic = self._topics.get(key, None)
+        if mqtt_topic is None:
+            if topic is None:
+                raise TypeError("A topic string must be specified.")
+            if subfolder is not None:
+                mqtt_topic = "{}{}/{}".format(self._prefix, topic, subfolder)
+            else:
+                mqtt_topic = self._prefix + topic
+            if self.topic_cache_size > 0:
+                if len(self._topics) >= self.topic_cache_size:
+                    self._topics.clear()
+                self._topics[key] = mqtt_topic
+        return mqtt_topic
 
     def subscribe(self, topic, subfolder=None, qos=1):
         """Subscribes to a Google Cloud IoT device topic.
@@ -208,11 +527,18 @@ class MQTT_API:
         :param str subfolder: Optional MQTT topic subfolder. Defaults to None.
         :param int qos: Quality of Service level for the message.
         """
-        if subfolder is not None:
-            mqtt_topic = "/devices/{}/{}/{}".format(self.device_id, topic, subfolder)
-        else:
-            mqtt_topic = "/devices/{}/{}".format(self.device_id, topic)
+        mqtt_topic = self._topic(topic, subfolder)
         self._client.subscribe(mqtt_topic, qos)
+        self._subscriptions[mqtt_topic] = qos
+
+    def unsubscribe(self, topic, subfolder=None):
+        """Unsubscribes from a Google Cloud IoT device topic.
+        :param str topic: Required MQTT topic.
+        :param str subfolder: Optional MQTT topic subfolder. Defaults to None.
+        """
+        mqtt_topic = self._topic(topic, subfolder)
+        self._client.unsubscribe(mqtt_topic)
+        self._subscriptions.pop(mqtt_topic, None)
 
     def subscribe_to_subfolder(self, topic, subfolder, qos=1):
         """Subscribes to a Google Cloud IoT device's topic subfolder
@@ -224,7 +550,8 @@ class MQTT_API:
 
     def subscribe_to_config(self, qos=1):
         """Subscribes to a Google Cloud IoT device's configuration
-        topic.
+        topic. If config is set, configurations are applied to it
+        and on_config is called when the configuration changes.
         :param int qos: Quality of Service level for the message.
         """
         self.subscribe("config", qos=qos)
@@ -235,54 +562,244 @@ class MQTT_API:
         """
         self.subscribe("commands/#", qos=qos)
 
-    def publish(self, payload, topic="events", subfolder=None, qos=0):
+    # pylint: disable=too-many-arguments
+    def publish(self, payload, topic="events", subfolder=None, qos=0, priority=None,
+                encode=True):
         """Publishes a payload from the device to its Google Cloud IoT
         device topic, defaults to "events" topic. To send state, use the
-        publish_state method.
+        publish_state method. If a codec is set, the payload is encoded with it
+        unless encode is False, and if a compressor is set, large events are
+        compressed. Returns False if the message was dropped by the rate_limiter
+        or the scheduler.
+        If an outbox is set, messages published while disconnected are queued in it.
+        If a scheduler is set, messages are queued in it and sent by loop().
+
+        MiniMQTT only publishes str, int and float payloads, so bytes, bytearray and
+        memoryview payloads are written to the client's socket. Buffers, such as
+        those from a Buffer_Pool, are not copied unless the message is queued.
 
         :param int payload: Data to publish to Google Cloud IoT
         :param str payload: Data to publish to Google Cloud IoT
         :param float payload: Data to publish to Google Cloud IoT
+        :param bytes payload: Data to publish to Google Cloud IoT
+        :param bytearray payload: Data to publish to Google Cloud IoT
+        :param memoryview payload: Data to publish to Google Cloud IoT
         :param str topic: Required MQTT topic. Defaults to events.
         :param str subfolder: Optional MQTT topic subfolder. Defaults to None.
         :param int qos: Quality of Service level for the message.
+        :param str priority: Optional Priority_Scheduler class for the message,
+            defaults to the class matching its topic.
+        :param bool encode: Encodes the payload with the codec, defaults to True.
+            Pass False for payloads which are already encoded.
         """
-        if subfolder is not None:
-            mqtt_topic = "/devices/{}/{}/{}".format(self.device_id, topic, subfolder)
-        elif topic is not None:
-            mqtt_topic = "/devices/{}/{}".format(self.device_id, topic)
-        elif topic == "state" and subfolder is not None:
+        if topic == "state" and subfolder is not None:
             raise ValueError("Subfolders are not supported for state messages.")
-        else:
-            raise TypeError("A topic string must be specified.")
-        self._client.publish(mqtt_topic, payload, qos=qos)
-
-    def publish_state(self, payload):
+        if encode and self.codec is not None:
+            # A view of the codec's buffer, copied only if needed
+            payload = self.codec.encode(payload)
+        if self.compressor is not None and topic == "events":
+            if isinstance(payload, str):
+                payload = payload.encode("utf-8")
+            elif isinstance(payload, (bytearray, memoryview)):
+                payload = bytes(payload)
+            if isinstance(payload, bytes):
+                payload, subfolder = self.compressor.compress(payload, subfolder)
+        return self._send(self._topic(topic, subfolder), payload, qos, priority)
+
+    def publish_state(self, payload, encode=True):
         """Publishes a device state message to the Cloud IoT MQTT API. Data
         sent by this method should be information about the device itself (such as number of
         crashes, battery level, or device health). This method is unidirectional,
         it communicates Device-to-Cloud only.
+
+        IoT Core limits devices to about one state update per second. A payload identical
+        to the last published state is skipped, and states published less than
+        state_interval seconds after the last one are held back, with only the latest
+        of them published by loop() once the interval has passed. Returns True if the
+        state was published immediately, False if it was skipped or held back.
+
+        :param payload: Data to publish.
+        :param bool encode: Encodes the payload with the codec, defaults to True.
+            Pass False for payloads which are already encoded.
+        """
+        if encode and self.codec is not None:
+            payload = self.codec.encode(payload)
+        if isinstance(payload, (bytearray, memoryview)):
+            # Kept as the last published state, so copied out of the buffer
+            payload = bytes(payload)
+        state_hash = hash(payload)
+        if state_hash == self._state_hash and payload == self._state:
+            # A pending state is superseded by one identical to the published state
+            if self._pending_state is not None:
+                self._pending_state = None
+                self.states_suppressed += 1
+            self.states_suppressed += 1
+            return False
+        if (self._state_time is not None
+                and time.monotonic() - self._state_time < self.state_interval):
+            if self._pending_state is not None:
+                self.states_suppressed += 1
+            self._pending_state = payload
+            return False
+        return self._send_state(payload, state_hash)
+
+    def _send_state(self, payload, state_hash):
+        """Publishes a device state message and records it as the last published state.
+        Returns False if it was rate limited or dropped, and held back for loop.
+        """
+        if not self._send(self._topic("state"), payload, 0):
+            # Rate limited, try again from loop
+            self._pending_state = payload
+            return False
+        self._state = payload
+        self._state_hash = state_hash
+        self._state_time = time.monotonic()
+        self._pending_state = None
+        return True
+
+    def _send(self, mqtt_topic, payload, qos, priority=None):
+        """Publishes an encoded payload to a full MQTT topic, or queues it in
+        the scheduler, or in the outbox if disconnected or rate limited. Returns
+        False if the payload was rate limited or dropped and not queued. If the
+        connection is found to be lost while publishing, the client is marked as
+        disconnected and the payload queued in the outbox, or the error raised
+        if there is no outbox.
+        """
+        if self.scheduler is not None:
+            if isinstance(payload, (bytearray, memoryview)):
+                payload = bytes(payload)
+            if not self.scheduler.put(mqtt_topic, payload, qos, priority):
+                return False
+        elif not self._connected and self.outbox is not None:
+            self._queue(mqtt_topic, payload, qos)
+        elif self.rate_limiter is not None and not self.rate_limiter.acquire(mqtt_topic):
+            if self.outbox is None:
+                return False
+            self._queue(mqtt_topic, payload, qos)
+        else:
+            try:
+                self._publish(mqtt_topic, payload, qos)
+            except Exception as error: # pylint: disable=broad-except
+                if not _is_connection_error(error):
+                    raise
+                self._connection_lost()
+                if self.outbox is None:
+                    raise
+                self._queue(mqtt_topic, payload, qos)
+        if self.metrics is not None:
+            self.metrics.record_publish(mqtt_topic, payload)
+        return True
+
+    def _publish(self, mqtt_topic, payload, qos):
+        """Publishes a payload with the client, or binary payloads, which
+        MiniMQTT doesn't accept, through its socket.
+        """
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            if self._writer is None:
+                # pylint: disable=cyclic-import
+                from adafruit_iotcore_packet import Packet_Writer
+                self._writer = Packet_Writer(self._client, self.topic_cache_size)
+            packet_id = self._writer.publish(mqtt_topic, payload, qos)
+            # As MiniMQTT does, QoS 0 messages have a packet id of 0
+            self._on_publish_mqtt(self._client, None, mqtt_topic, packet_id)
+        else:
+            self._client.publish(mqtt_topic, payload, qos=qos)
+
+    def _queue(self, mqtt_topic, payload, qos):
+        """Queues a message in the outbox, copying buffer payloads which the
+        caller may reuse.
+        """
+        if isinstance(payload, (bytearray, memoryview)):
+            payload = bytes(payload)
+        self.outbox.put(mqtt_topic, payload, qos)
+
+
+def _encode_dict(codec, value):
+    """Returns a dict encoded with codec if it encodes dicts, otherwise as JSON.
+    """
+    if codec is not None and getattr(codec, "encodes_dicts", False):
+        return codec.encode(value)
+    return json.dumps(value)
+
+
+class Backoff:
+    """Exponential backoff between reconnection attempts, with random jitter.
+
+    :param float initial: Delay before the first attempt, in seconds.
+    :param float maximum: Longest delay, in seconds.
+    :param float factor: Multiplier applied to the delay after each failed attempt.
+    :param float jitter: Fraction of each delay which is random, from 0 to 1.
+    """
+
+    def __init__(self, initial=1, maximum=120, factor=2, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next_delay(self):
+        """Returns the delay before the next attempt, in seconds.
+        """
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        if delay < self.maximum:
+            self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        """Starts again from the initial delay, after a successful attempt.
         """
-        self._client.publish(payload, "state")
+        self.attempts = 0
+
+
+class ESPSPI_Network:
+    """Network backend for an ESP32SPI WiFiManager. Network backends have a
+    get(url, headers=None) method returning a response with text, headers
+    and close(), and are used by Cloud_Core and the time sources.
+
+    :param wifi_manager: ESP32SPI WiFiManager object.
+    """
+
+    def __init__(self, wifi_manager):
+        self.wifi = wifi_manager
+
+    def get(self, url, headers=None):
+        """Sends a GET request through the WiFiManager, returning its response.
+        """
+        if headers is None:
+            return self.wifi.get(url)
+        return self.wifi.get(url, headers=headers)
 
 
 # pylint: disable=too-many-instance-attributes
 class Cloud_Core:
     """CircuitPython Google Cloud IoT Core module.
 
-    :param network_manager: Network Manager module, such as WiFiManager.
+    :param network_manager: Network backend, such as an ESP32SPI WiFiManager (used
+        through ESPSPI_Network) or an adafruit_iotcore_http.HTTP_Session.
     :param dict secrets: Secrets.py file.
     :param bool log: Enable Cloud_Core logging, defaults to False.
+    :param ecdsa_signer: Optional callable used to sign ES256 JWTs, such as a wrapper
+        around an ATECC608's ecdsa_sign. It is passed the JWT signing input as bytes
+        and must return the 64-byte raw (r || s) P-256 signature. If provided, JWTs
+        are signed with ES256 instead of RS256 and secrets["private_key"] is optional.
 
     """
 
-    def __init__(self, network_manager, secrets, log=False):
+    __slots__ = (
+        "_wifi", "_secrets", "_logger", "_proj_id", "_region", "_reg_id", "_device_id",
+        "_private_key", "_ecdsa_signer", "_rsa_key", "_jwt_headers", "_time_service",
+        "_jwt", "_jwt_exp", "time_sync", "broker", "username", "cid", "jwt_ttl", "jwt_algo",
+        "jwt_refresh_margin", "jwt_cache_hits", "jwt_refreshes",
+    )
+
+    def __init__(self, network_manager, secrets, log=False, ecdsa_signer=None):
         # Validate NetworkManager
-        network_manager_type = str(type(network_manager))
-        if "ESPSPI_WiFiManager" in network_manager_type:
-            self._wifi = network_manager
-        else:
-            raise TypeError("This library requires a NetworkManager object.")
+        if "ESPSPI_WiFiManager" in str(type(network_manager)):
+            network_manager = ESPSPI_Network(network_manager)
+        elif not hasattr(network_manager, "get"):
+            raise TypeError("This library requires a network backend object.")
+        self._wifi = network_manager
         # Validate Secrets
         if hasattr(secrets, "keys"):
             self._secrets = secrets
@@ -292,6 +809,7 @@ class Cloud_Core:
             )
         self._logger = None
         if log is True:
+            import adafruit_logging as logging
             self._logger = logging.getLogger("log")
             self._logger.setLevel(logging.DEBUG)
         # Configuration, from secrets file
@@ -299,10 +817,27 @@ class Cloud_Core:
         self._region = secrets["cloud_region"]
         self._reg_id = secrets["registry_id"]
         self._device_id = secrets["device_id"]
-        self._private_key = secrets["private_key"]
+        self._private_key = secrets.get("private_key")
+        self._ecdsa_signer = ecdsa_signer
+        # Parsed RSA private key and encoded JWT headers, built once on first use
+        self._rsa_key = None
+        self._jwt_headers = {}
+        # Time used for JWT claims, see adafruit_iotcore_time.Time_Sync
+        # pylint: disable=cyclic-import
+        from adafruit_iotcore_time import Strftime_Time_Source, Time_Sync
+        self._time_service = Strftime_Time_Source(network_manager, secrets, self._logger)
+        self.time_sync = Time_Sync(self._time_service)
         self.broker = "mqtt.googleapis.com"
         self.username = b"unused"
         self.cid = self.client_id
+        # Cached JSON Web Token, refreshed jwt_refresh_margin seconds before it expires
+        self._jwt = None
+        self._jwt_exp = 0
+        self.jwt_ttl = 43200
+        self.jwt_algo = "RS256" if ecdsa_signer is None else "ES256"
+        self.jwt_refresh_margin = 600
+        self.jwt_cache_hits = 0
+        self.jwt_refreshes = 0
 
     @property
     def client_id(self):
@@ -315,76 +850,98 @@ class Cloud_Core:
             self._logger.debug("Client ID: {}".format(client_id))
         return client_id
 
+    @property
+    def jwt(self):
+        """Returns a cached JSON Web Token. A new token is only generated once the
+        cached token is within jwt_refresh_margin seconds of its expiry.
+        """
+        if self.jwt_expiring:
+            return self.generate_jwt(self.jwt_ttl, self.jwt_algo)
+        self.jwt_cache_hits += 1
+        return self._jwt
+
+    @property
+    def jwt_expiring(self):
+        """Returns True if there is no cached JWT or if the cached JWT
+        expires within jwt_refresh_margin seconds.
+        """
+        if self._jwt is None:
+            return True
+        return self.time_sync.time() >= self._jwt_exp - self.jwt_refresh_margin
+
+    @property
+    def jwt_expires(self):
+        """Returns the expiry (exp claim) of the cached JWT, 0 if there is none.
+        """
+        return self._jwt_exp
 
-    def generate_jwt(self, ttl=43200, algo="RS256"):
-        """Generates a JSON Web Token (https://jwt.io/) using network time.
+    def generate_jwt(self, ttl=43200, algo=None):
+        """Generates a JSON Web Token (https://jwt.io/) using network time from time_sync.
         :param int jwt_ttl: When the JWT token expires, defaults to 43200 minutes (or 12 hours).
-        :param str algo: Algorithm used to create a JSON Web Token.
+        :param str algo: Algorithm used to create a JSON Web Token, one of RS256, RS384,
+            RS512 or ES256, defaults to jwt_algo. ES256 requires Cloud_Core to be
+            constructed with an ecdsa_signer, and is then the default.
 
         Example usage of generating and setting a JSON-Web-Token:
         ..code-block:: python
 
             jwt = CloudCore.generate_jwt()
             print("Generated JWT: ", jwt)
+
+        The generated token is cached and returned by the jwt property until it is
+        close to expiring. The time is only fetched when time_sync needs to sync,
+        which with the default time source also sets the board's real-time clock.
         """
+        from adafruit_jwt import STRING_TOOLS
+        if algo is None:
+            algo = self.jwt_algo
         if self._logger:
             self._logger.debug("Generating JWT...")
-        self._get_local_time()
+        now = self.time_sync.time()
         claims = {
             # The time that the token was issued at
-            "iat": time.time(),
+            "iat": now,
             # The time the token expires.
-            "exp": time.time() + ttl,
+            "exp": now + ttl,
             # The audience field should always be set to the GCP project id.
             "aud": self._proj_id,
         }
-        jwt = JWT.generate(claims, self._private_key, algo)
+        payload = "{}.{}".format(
+            self._jwt_header(algo),
+            STRING_TOOLS.urlsafe_b64encode(json.dumps(claims).encode("utf-8")),
+        )
+        jwt = payload + "." + STRING_TOOLS.urlsafe_b64encode(self._sign(payload, algo))
+        self._jwt = jwt
+        self._jwt_exp = claims["exp"]
+        self.jwt_refreshes += 1
         return jwt
 
-    # pylint: disable=line-too-long, too-many-locals
-    def _get_local_time(self):
-        """Fetch and "set" the local time of this microcontroller to the
-        local time at the location, using an internet time API.
-        from Adafruit IO Arduino
+    def _jwt_header(self, algo):
+        """Returns the base64url-encoded JOSE header for algo, encoding
+        it only the first time it is requested.
         """
-        api_url = None
-        try:
-            aio_username = self._secrets["aio_username"]
-            aio_key = self._secrets["aio_key"]
-        except KeyError:
-            raise KeyError(
-                "\n\nOur time service requires a login/password to rate-limit. Please register for a free adafruit.io account and place the user/key in your secrets file under 'aio_username' and 'aio_key'"
+        header = self._jwt_headers.get(algo)
+        if header is None:
+            if algo != "ES256" and algo not in RSA_HASH_METHODS:
+                raise ValueError("Unsupported JWT algorithm: {}".format(algo))
+            from adafruit_jwt import STRING_TOOLS
+            header = STRING_TOOLS.urlsafe_b64encode(
+                json.dumps({"typ": "JWT", "alg": algo}).encode("utf-8")
             )
-        location = None
-        location = self._secrets.get("timezone", location)
-        if location:
-            if self._logger:
-                self._logger.debug("Getting time for timezone.")
-            api_url = (TIME_SERVICE + "&tz=%s") % (aio_username, aio_key, location)
-        else:  # we'll try to figure it out from the IP address
-            self._logger.debug("Getting time from IP Address..")
-            api_url = TIME_SERVICE % (aio_username, aio_key)
-        api_url += TIME_SERVICE_STRFTIME
-        try:
-            response = self._wifi.get(api_url)
-            times = response.text.split(" ")
-            the_date = times[0]
-            the_time = times[1]
-            year_day = int(times[2])
-            week_day = int(times[3])
-            is_dst = None  # no way to know yet
-        except KeyError:
-            raise KeyError(
-                "Was unable to lookup the time, try setting secrets['timezone'] according to http://worldtimeapi.org/timezones"
-            )  # pylint: disable=line-too-long
-        year, month, mday = [int(x) for x in the_date.split("-")]
-        the_time = the_time.split(".")[0]
-        hours, minutes, seconds = [int(x) for x in the_time.split(":")]
-        now = time.struct_time(
-            (year, month, mday, hours, minutes, seconds, week_day, year_day, is_dst)
-        )
-        rtc.RTC().datetime = now
-        # now clean up
-        response.close()
-        response = None
-        gc.collect()
+            self._jwt_headers[algo] = header
+        return header
+
+    def _sign(self, payload, algo):
+        """Signs the JWT signing input, payload, using algo.
+        """
+        if algo == "ES256":
+            if self._ecdsa_signer is None:
+                raise ValueError("ES256 JWTs require an ecdsa_signer.")
+            return self._ecdsa_signer(payload.encode("utf-8"))
+        from adafruit_rsa import PrivateKey, sign
+        if self._rsa_key is None:
+            if self._private_key is None:
+                raise KeyError("RSA JWTs require a private_key in the secrets file.")
+            # Parse the private key once, rather than for every JWT
+            self._rsa_key = PrivateKey(*self._private_key)
+        return sign(payload.encode("utf-8"), self._rsa_key, RSA_HASH_METHODS[algo])
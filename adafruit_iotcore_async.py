@@ -0,0 +1,357 @@
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Modified by Brent Rubell for Adafruit Industries, 2019
+"""
+`adafruit_iotcore_async`
+================================================================================
+
+asyncio client for Google Cloud IoT Core's MQTT bridge, for CPython gateways.
+Kept apart from adafruit_iotcore so that microcontrollers don't load it.
+
+* Author(s): Brent Rubell, Google Inc.
+
+Implementation Notes
+--------------------
+
+**Software and Dependencies:**
+
+* CPython 3.5 or later, with asyncio.
+
+"""
+import asyncio
+import struct
+
+from adafruit_iotcore import MQTT_API_ERROR
+from adafruit_iotcore_packet import _mqtt_packet, _mqtt_string
+
+__version__ = "0.0.0-auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_Cloud_IOT_Core.git"
+
+
+# pylint: disable=too-many-instance-attributes
+class AsyncMQTT_API:
+    """asyncio client for Google's Cloud Core MQTT API, for CPython gateways
+    serving many devices from one event loop.
+
+    :param str client_id: Device's Client ID, such as Cloud_Core's cid.
+    :param str password: JSON Web Token for the device.
+    :param str broker: MQTT broker hostname.
+    :param int port: MQTT broker port.
+    :param transport: Optional coroutine function taking (host, port) and returning an
+        asyncio (StreamReader, StreamWriter) pair. Defaults to a TLS connection
+        opened with asyncio.open_connection.
+
+    QoS 1 messages are pipelined: up to max_inflight messages may be awaiting their
+    PUBACK at once, and each is sent again with the DUP flag if it hasn't been
+    acknowledged within retransmit_timeout seconds.
+
+    Example of publishing and reading commands:
+    ..code-block:: python
+
+        async def device(cloud_core):
+            async with AsyncMQTT_API(cloud_core.cid, cloud_core.jwt) as google_mqtt:
+                await google_mqtt.subscribe_to_all_commands()
+                await google_mqtt.publish("online")
+                async for topic, payload in google_mqtt:
+                    print(topic, payload)
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, client_id, password, broker="mqtt.googleapis.com", port=8883,
+                 transport=None):
+        self._client_id = client_id
+        self._password = password
+        self.broker = broker
+        self.port = port
+        self._transport = transport or self._open_tls
+        self.keep_alive = 1140
+        self.device_id = client_id.split("/")[7]
+        self._prefix = "/devices/{}/".format(self.device_id)
+        self.codec = None
+        self._reader = None
+        self._writer = None
+        self._tasks = []
+        self._packet_id = 0
+        # Futures for PUBACKs and SUBACKs, keyed by packet id
+        self._pending = {}
+        self._messages = asyncio.Queue()
+        self._connected = False
+        # QoS 1 in-flight window, with a retransmit timer for each unacknowledged message
+        self.max_inflight = 16
+        self.retransmit_timeout = 10
+        self.retransmits = 0
+        self._window = None
+        self._timers = {}
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exception_type, exception_value, traceback):
+        await self.disconnect()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self._messages.get()
+        if message is None:
+            # Leave the end marker for any other iterators
+            self._messages.put_nowait(None)
+            raise StopAsyncIteration
+        return message
+
+    @staticmethod
+    async def _open_tls(host, port):
+        """Opens a TLS connection to the broker.
+        """
+        return await asyncio.open_connection(host, port, ssl=True)
+
+    @property
+    def is_connected(self):
+        """Returns if client is connected to Google's MQTT broker.
+        """
+        return self._connected
+
+    async def connect(self):
+        """Connects to the Google MQTT Broker.
+        """
+        self._reader, self._writer = await self._transport(self.broker, self.port)
+        self._messages = asyncio.Queue()
+        self._window = asyncio.Semaphore(self.max_inflight)
+        # Protocol level 4 (MQTT 3.1.1), username and password flags, clean session
+        body = (_mqtt_string("MQTT") + struct.pack(">BBH", 4, 0xC2, self.keep_alive)
+                + _mqtt_string(self._client_id) + _mqtt_string("unused")
+                + _mqtt_string(self._password))
+        self._writer.write(_mqtt_packet(0x10, body))
+        await self._writer.drain()
+        packet_type, body = await self._read_packet()
+        if packet_type != 0x20:
+            raise MQTT_API_ERROR("Expected CONNACK, got {}".format(packet_type))
+        if body[1] != 0:
+            raise MQTT_API_ERROR(body[1])
+        self._connected = True
+        self._tasks = [asyncio.ensure_future(self._read_loop()),
+                       asyncio.ensure_future(self._ping_loop())]
+
+    async def disconnect(self):
+        """Disconnects from the Google MQTT Broker.
+        """
+        if self._connected:
+            self._writer.write(b"\xe0\x00")
+            await self._writer.drain()
+        self._close()
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def _close(self):
+        """Closes the connection and ends iteration over inbound messages.
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._connected:
+            self._connected = False
+            self._messages.put_nowait(None)
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers = {}
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(MQTT_API_ERROR("Disconnected."))
+        self._pending = {}
+
+    async def _read_packet(self):
+        """Reads an MQTT packet, returning its type and body.
+        """
+        header = await self._reader.readexactly(1)
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await self._reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        return header[0], await self._reader.readexactly(length)
+
+    async def _read_loop(self):
+        """Reads packets from the broker until the connection closes.
+        """
+        try:
+            while True:
+                packet_type, body = await self._read_packet()
+                if packet_type & 0xF0 == 0x30:
+                    topic_length = struct.unpack_from(">H", body)[0]
+                    topic = body[2:2 + topic_length].decode("utf-8")
+                    offset = 2 + topic_length
+                    if packet_type & 0x06 == 0x02:
+                        # QoS 1, acknowledge the message
+                        self._writer.write(_mqtt_packet(0x40, body[offset:offset + 2]))
+                        offset += 2
+                    await self._messages.put((topic, body[offset:]))
+                elif packet_type in (0x40, 0x90):
+                    future = self._pending.pop(struct.unpack_from(">H", body)[0], None)
+                    if future is not None and not future.done():
+                        future.set_result(body[2:])
+        except (asyncio.IncompleteReadError, OSError):
+            self._close()
+
+    async def _ping_loop(self):
+        """Sends a PINGREQ every keep_alive seconds.
+        """
+        while self._connected:
+            await asyncio.sleep(self.keep_alive)
+            if self._writer is not None:
+                self._writer.write(b"\xc0\x00")
+                await self._writer.drain()
+
+    def _next_packet_id(self):
+        """Returns the next MQTT packet id and a future for its acknowledgement.
+        """
+        self._packet_id = self._packet_id % 65535 + 1
+        future = asyncio.get_event_loop().create_future()
+        self._pending[self._packet_id] = future
+        return self._packet_id, future
+
+    @property
+    def inflight(self):
+        """Returns the number of QoS 1 messages awaiting their PUBACK.
+        """
+        return len(self._timers)
+
+    def _retransmit_later(self, packet_id, packet):
+        """Sends a QoS 1 packet again, with the DUP flag, if it isn't acknowledged
+        within retransmit_timeout seconds.
+        """
+        self._timers[packet_id] = asyncio.get_event_loop().call_later(
+            self.retransmit_timeout, self._retransmit, packet_id, packet)
+
+    def _retransmit(self, packet_id, packet):
+        """Sends an unacknowledged QoS 1 packet again.
+        """
+        if packet_id not in self._timers or self._writer is None:
+            return
+        self._writer.write(bytes((packet[0] | 0x08,)) + packet[1:])
+        self.retransmits += 1
+        self._retransmit_later(packet_id, packet)
+
+    def _acknowledged(self, packet_id, window):
+        """Frees a QoS 1 message's place in the in-flight window.
+        """
+        timer = self._timers.pop(packet_id, None)
+        if timer is not None:
+            timer.cancel()
+        window.release()
+
+    def _topic(self, topic, subfolder=None):
+        """Returns the full MQTT topic for a device topic and optional subfolder.
+        """
+        if subfolder is not None:
+            return "{}{}/{}".format(self._prefix, topic, subfolder)
+        return self._prefix + topic
+
+    async def subscribe(self, topic, subfolder=None, qos=1):
+        """Subscribes to a Google Cloud IoT device topic, returning the granted QoS.
+        :param str topic: Required MQTT topic.
+        :param str subfolder: Optional MQTT topic subfolder. Defaults to None.
+        :param int qos: Quality of Service level for the message, 0 or 1. IoT Core
+            doesn't support QoS 2.
+        """
+        if qos not in (0, 1):
+            raise ValueError("Only QoS 0 and 1 are supported.")
+        if not self._connected:
+            raise MQTT_API_ERROR("Disconnected.")
+        packet_id, future = self._next_packet_id()
+        body = (struct.pack(">H", packet_id) + _mqtt_string(self._topic(topic, subfolder))
+                + bytes((qos,)))
+        self._writer.write(_mqtt_packet(0x82, body))
+        await self._writer.drain()
+        granted = (await future)[0]
+        if granted == 0x80:
+            raise MQTT_API_ERROR("Subscription to {} was refused.".format(topic))
+        return granted
+
+    async def subscribe_to_config(self, qos=1):
+        """Subscribes to a Google Cloud IoT device's configuration topic.
+        :param int qos: Quality of Service level for the message.
+        """
+        return await self.subscribe("config", qos=qos)
+
+    async def subscribe_to_all_commands(self, qos=1):
+        """Subscribes to a device's "commands/#" topic.
+        :param int qos: Quality of Service level for the message.
+        """
+        return await self.subscribe("commands/#", qos=qos)
+
+    # pylint: disable=too-many-arguments
+    async def publish(self, payload, topic="events", subfolder=None, qos=0, wait=True):
+        """Publishes a payload to a Google Cloud IoT device topic, defaults to the
+        "events" topic. With qos=1, waits for a place in the in-flight window, then
+        returns a future which completes when the broker acknowledges the message.
+
+        :param payload: Data to publish, as a str, bytes, int or float.
+        :param str topic: Required MQTT topic. Defaults to events.
+        :param str subfolder: Optional MQTT topic subfolder. Defaults to None.
+        :param int qos: Quality of Service level for the message, 0 or 1.
+        :param bool wait: With qos=1, waits for the acknowledgement before returning.
+
+        Example of pipelining QoS 1 messages:
+        ..code-block:: python
+
+            acks = [await google_mqtt.publish(reading, qos=1, wait=False)
+                    for reading in readings]
+            await asyncio.gather(*acks)
+
+        """
+        if topic == "state" and subfolder is not None:
+            raise ValueError("Subfolders are not supported for state messages.")
+        if qos not in (0, 1):
+            raise ValueError("Only QoS 0 and 1 are supported.")
+        if not self._connected:
+            raise MQTT_API_ERROR("Disconnected.")
+        if self.codec is not None:
+            payload = bytes(self.codec.encode(payload))
+        elif isinstance(payload, (int, float)):
+            payload = str(payload).encode("ascii")
+        elif isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        body = _mqtt_string(self._topic(topic, subfolder))
+        if not qos:
+            self._writer.write(_mqtt_packet(0x30, body + payload))
+            await self._writer.drain()
+            return None
+        window = self._window
+        await window.acquire()
+        if not self._connected:
+            window.release()
+            raise MQTT_API_ERROR("Disconnected.")
+        packet_id, future = self._next_packet_id()
+        future.add_done_callback(
+            lambda _, acked=packet_id: self._acknowledged(acked, window))
+        packet = _mqtt_packet(0x32, body + struct.pack(">H", packet_id) + payload)
+        self._writer.write(packet)
+        self._retransmit_later(packet_id, packet)
+        await self._writer.drain()
+        if wait:
+            await future
+        return future
+
+    async def publish_state(self, payload):
+        """Publishes a device state message to the Cloud IoT MQTT API.
+        """
+        return await self.publish(payload, "state")
@@ -0,0 +1,311 @@
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Modified by Brent Rubell for Adafruit Industries, 2019
+"""
+`adafruit_iotcore_codec`
+================================================================================
+
+Payload codecs, buffers and compression for MQTT_API. Kept apart from
+adafruit_iotcore so that devices only load the features they use.
+
+* Author(s): Brent Rubell, Google Inc.
+
+Implementation Notes
+--------------------
+
+**Software and Dependencies:**
+
+* Adafruit CircuitPython firmware for the supported boards:
+  https://github.com/adafruit/circuitpython/releases
+
+"""
+import struct
+import time
+
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
+__version__ = "0.0.0-auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_Cloud_IOT_Core.git"
+
+# CBOR encodings of None, False and True
+CBOR_SIMPLE_VALUES = {None: 0xF6, False: 0xF4, True: 0xF5}
+
+
+class CBOR_Codec:
+    """Encodes payloads as CBOR (RFC 7049) into a reusable buffer. Supports
+    None, bools, ints, floats, str, bytes, lists, tuples and dicts. Floats are
+    encoded in single precision, the precision of CircuitPython's floats.
+
+    :param int size: Size of the encoding buffer, the largest encoded payload.
+
+    Example of publishing CBOR-encoded events:
+    ..code-block:: python
+
+        google_mqtt.codec = CBOR_Codec()
+        google_mqtt.publish({"temperature": 21.5, "humidity": 40})
+
+    """
+
+    # Summaries and metrics, which are dicts, are encoded with this codec
+    encodes_dicts = True
+
+    def __init__(self, size=256):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+    def encode(self, value):
+        """Encodes value, returning a memoryview of the codec's buffer which is
+        only valid until the next call to encode.
+        """
+        return self._view[:self._encode(value, 0)]
+
+    def _reserve(self, offset, size):
+        """Checks that size bytes fit in the buffer at offset.
+        """
+        if offset + size > len(self._buffer):
+            raise ValueError("Payload is larger than the codec's buffer.")
+
+    def _head(self, major, value, offset):
+        """Writes a CBOR data item head, returns the offset after it.
+        """
+        major <<= 5
+        if value < 24:
+            self._reserve(offset, 1)
+            self._buffer[offset] = major | value
+            return offset + 1
+        if value < 0x100:
+            fmt, info, size = ">BB", 24, 2
+        elif value < 0x10000:
+            fmt, info, size = ">BH", 25, 3
+        elif value < 0x100000000:
+            fmt, info, size = ">BI", 26, 5
+        else:
+            fmt, info, size = ">BQ", 27, 9
+        self._reserve(offset, size)
+        struct.pack_into(fmt, self._buffer, offset, major | info, value)
+        return offset + size
+
+    # pylint: disable=too-many-return-statements
+    def _encode(self, value, offset):
+        """Writes value at offset, returns the offset after it.
+        """
+        if value is None or value is True or value is False:
+            self._reserve(offset, 1)
+            self._buffer[offset] = CBOR_SIMPLE_VALUES[value]
+            return offset + 1
+        if isinstance(value, int):
+            if value >= 0:
+                return self._head(0, value, offset)
+            return self._head(1, -1 - value, offset)
+        if isinstance(value, float):
+            self._reserve(offset, 5)
+            struct.pack_into(">Bf", self._buffer, offset, 0xFA, value)
+            return offset + 5
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+            offset = self._head(3, len(value), offset)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            offset = self._head(2, len(value), offset)
+        elif isinstance(value, (list, tuple)):
+            offset = self._head(4, len(value), offset)
+            for item in value:
+                offset = self._encode(item, offset)
+            return offset
+        elif isinstance(value, dict):
+            offset = self._head(5, len(value), offset)
+            for key in value:
+                offset = self._encode(key, offset)
+                offset = self._encode(value[key], offset)
+            return offset
+        else:
+            raise TypeError("Can not encode {} as CBOR.".format(type(value)))
+        # Byte and text strings
+        self._reserve(offset, len(value))
+        self._view[offset:offset + len(value)] = value
+        return offset + len(value)
+
+
+class Struct_Codec:
+    """Encodes payloads with registered struct formats into a reusable buffer.
+    The first byte of each payload is the schema id, so the cloud can
+    unpack the rest of it with the same format.
+
+    :param int size: Size of the encoding buffer, the largest encoded payload.
+
+    Example of publishing struct-encoded events:
+    ..code-block:: python
+
+        codec = Struct_Codec()
+        codec.register(1, "<fH")
+        google_mqtt.codec = codec
+        google_mqtt.publish((1, (21.5, 40)))
+
+    """
+
+    # Summaries and metrics, which are dicts, are JSON encoded instead
+    encodes_dicts = False
+
+    def __init__(self, size=64):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._schemas = {}
+
+    def register(self, schema_id, fmt):
+        """Registers a struct format.
+
+        :param int schema_id: Schema id, from 0 to 255.
+        :param str fmt: struct format string for the schema's values.
+        """
+        if not 0 <= schema_id <= 255:
+            raise ValueError("Schema ids must be from 0 to 255.")
+        size = struct.calcsize(fmt) + 1
+        if size > len(self._buffer):
+            raise ValueError("Schema is larger than the codec's buffer.")
+        self._schemas[schema_id] = (fmt, size)
+
+    def encode(self, value):
+        """Encodes value, a tuple of a registered schema id and the values to
+        pack. Returns a memoryview of the codec's buffer which is only valid
+        until the next call to encode.
+        """
+        schema_id, values = value
+        try:
+            fmt, size = self._schemas[schema_id]
+        except KeyError:
+            raise ValueError("Schema {} is not registered.".format(schema_id))
+        self._buffer[0] = schema_id
+        struct.pack_into(fmt, self._buffer, 1, *values)
+        return self._view[:size]
+
+    def decode(self, payload):
+        """Decodes a payload, returning a tuple of its schema id and values.
+        """
+        fmt, _ = self._schemas[payload[0]]
+        return payload[0], struct.unpack_from(fmt, payload, 1)
+
+
+class Buffer_Pool:
+    """Fixed set of reusable payload buffers, filled in place (such as with
+    struct.pack_into) and published without allocating any memory. Each buffer
+    is a bytearray of size bytes, publish part of one with a memoryview slice.
+    A buffer can be released as soon as publish returns.
+
+    :param int count: Number of buffers.
+    :param int size: Size of each buffer, in bytes.
+
+    Example of publishing a binary sensor frame:
+    ..code-block:: python
+
+        pool = Buffer_Pool(2, struct.calcsize("<ffH"))
+
+        frame = pool.acquire()
+        struct.pack_into("<ffH", frame, 0, temperature, humidity, battery)
+        google_mqtt.publish(frame)
+        pool.release(frame)
+
+    """
+
+    def __init__(self, count=4, size=64):
+        self.size = size
+        self._free = [bytearray(size) for _ in range(count)]
+
+    def __len__(self):
+        return len(self._free)
+
+    def acquire(self):
+        """Returns a free buffer. Raises RuntimeError if every buffer is in use.
+        """
+        if not self._free:
+            raise RuntimeError("Every buffer in the pool is in use.")
+        return self._free.pop()
+
+    def release(self, buffer):
+        """Returns a buffer from acquire to the pool.
+        """
+        if len(buffer) != self.size:
+            raise ValueError("Buffer is not from this pool.")
+        self._free.append(buffer)
+
+
+class Deflate_Compressor:
+    """Compresses event payloads of threshold bytes or more with zlib. Compressed
+    messages are published to a "deflate" subfolder, appended to any subfolder,
+    so the cloud can tell them apart. Requires zlib.compressobj, which is
+    available on CPython but not in CircuitPython's zlib module.
+
+    :param int threshold: Smallest payload compressed, in bytes.
+    :param int level: zlib compression level, from 0 to 9.
+
+    Example of compressing large events:
+    ..code-block:: python
+
+        google_mqtt.compressor = Deflate_Compressor(threshold=256)
+        google_mqtt.publish(log_dump, subfolder="logs")  # sent to events/logs/deflate
+
+    """
+
+    def __init__(self, threshold=512, level=6):
+        if zlib is None or not hasattr(zlib, "compressobj"):
+            raise RuntimeError("Compression requires zlib.compressobj.")
+        self.threshold = threshold
+        # Compressor state is set up once and copied for each message
+        self._compressor = zlib.compressobj(level)
+        self._subfolders = {}
+        # Compression statistics
+        self.messages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0
+
+    def compress(self, payload, subfolder=None):
+        """Compresses payload if it is at least threshold bytes. Returns a tuple of
+        the payload and the subfolder to publish it to.
+
+        :param bytes payload: Data to compress.
+        :param str subfolder: Subfolder the payload would be published to.
+        """
+        if len(payload) < self.threshold:
+            return payload, subfolder
+        start = time.monotonic()
+        compressor = self._compressor.copy()
+        compressed = compressor.compress(payload) + compressor.flush()
+        self.seconds += time.monotonic() - start
+        self.messages += 1
+        self.bytes_in += len(payload)
+        self.bytes_out += len(compressed)
+        tagged = self._subfolders.get(subfolder, None)
+        if tagged is None:
+            tagged = "deflate" if subfolder is None else subfolder + "/deflate"
+            self._subfolders[subfolder] = tagged
+        return compressed, tagged
+
+    @property
+    def ratio(self):
+        """Returns the average ratio of compressed to uncompressed size.
+        """
+        if self.bytes_in == 0:
+            return 1.0
+        return self.bytes_out / self.bytes_in
+
+    @property
+    def seconds_per_message(self):
+        """Returns the average time spent compressing a message, in seconds.
+        """
+        if self.messages == 0:
+            return 0
+        return self.seconds / self.messages
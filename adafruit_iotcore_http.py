@@ -0,0 +1,217 @@
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Modified by Brent Rubell for Adafruit Industries, 2019
+"""
+`adafruit_iotcore_http`
+================================================================================
+
+Network backend for Cloud_Core on CPython, such as on a Linux gateway.
+Kept apart from adafruit_iotcore so that microcontrollers don't load it.
+
+* Author(s): Brent Rubell, Google Inc.
+
+Implementation Notes
+--------------------
+
+**Software and Dependencies:**
+
+* CPython 3.5 or later.
+
+"""
+import http.client
+import json
+import socket
+import ssl
+import time
+
+__version__ = "0.0.0-auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_Cloud_IOT_Core.git"
+
+
+class _HTTP_Connection(http.client.HTTPConnection):
+    """HTTPConnection which opens its socket with a session's create_connection.
+    """
+
+    def __init__(self, create_connection, host, port, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self._create_connection = create_connection
+
+
+class _HTTPS_Connection(http.client.HTTPSConnection):
+    """HTTPSConnection which opens its socket with a session's create_connection.
+    TLS still verifies the host name.
+    """
+
+    def __init__(self, create_connection, host, port, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self._create_connection = create_connection
+
+
+class HTTP_Response:
+    """Response from an HTTP_Session, read in full so that its connection can be reused.
+    Header names are lowercase.
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        """Returns the body of the response as a str.
+        """
+        return self.content.decode("utf-8")
+
+    def json(self):
+        """Returns the body of the response decoded from JSON.
+        """
+        return json.loads(self.content)
+
+    def close(self):
+        """Does nothing, the connection has already been returned to its session.
+        """
+
+
+# pylint: disable=too-many-instance-attributes
+class HTTP_Session:
+    """Network backend for CPython, such as on a Linux gateway. Connections are
+    kept alive and reused for later requests to the same host, and DNS lookups
+    are cached, so repeated time syncs don't repeat the TCP and TLS handshakes.
+
+    :param float timeout: Timeout for connecting and reading, in seconds.
+    :param int max_connections: Most idle connections kept for each host.
+    :param int dns_ttl: Seconds a DNS lookup is cached for.
+    :param ssl_context: Optional ssl.SSLContext for https URLs, defaults to
+        ssl.create_default_context().
+
+    Example of using a session on a gateway:
+    ..code-block:: python
+
+        cloud_core = Cloud_Core(HTTP_Session(timeout=5), secrets)
+
+    """
+
+    def __init__(self, timeout=10, max_connections=2, dns_ttl=300, ssl_context=None):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.dns_ttl = dns_ttl
+        self._ssl_context = ssl_context
+        # Idle connections keyed by (scheme, host, port)
+        self._idle = {}
+        # ([(family, address)], expiry) keyed by (host, port)
+        self._dns = {}
+        self.requests = 0
+        self.connections = 0
+        self.dns_lookups = 0
+
+    @staticmethod
+    def _split_url(url):
+        """Returns the scheme, host, port and path of url.
+        """
+        scheme, _, rest = url.partition("://")
+        netloc, slash, path = rest.partition("/")
+        host, _, port = netloc.partition(":")
+        if port:
+            port = int(port)
+        else:
+            port = 443 if scheme == "https" else 80
+        return scheme, host, port, slash + path
+
+    def _resolve(self, host, port):
+        """Returns the family and address of each of host's addresses, looking
+        them up if they aren't cached.
+        """
+        entry = self._dns.get((host, port), None)
+        now = time.monotonic()
+        if entry is None or entry[1] <= now:
+            addresses = [(family, address) for family, _, _, _, address
+                         in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+            self.dns_lookups += 1
+            entry = (addresses, now + self.dns_ttl)
+            self._dns[(host, port)] = entry
+        return entry[0]
+
+    def _create_connection(self, address, timeout, source_address=None):
+        """Opens a socket to the first of the cached addresses of (host, port)
+        which accepts a connection, as socket.create_connection does.
+        """
+        self.connections += 1
+        error = OSError("No addresses for {}.".format(address[0]))
+        for family, sockaddr in self._resolve(*address):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(timeout)
+                if source_address is not None:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except OSError as connect_error:
+                sock.close()
+                error = connect_error
+        # Look the host up again next time, its addresses may have changed
+        self._dns.pop(address, None)
+        raise error
+
+    def _connection(self, scheme, host, port):
+        """Returns a new connection to a host.
+        """
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            return _HTTPS_Connection(self._create_connection, host, port,
+                                     timeout=self.timeout, context=self._ssl_context)
+        return _HTTP_Connection(self._create_connection, host, port, timeout=self.timeout)
+
+    def get(self, url, headers=None):
+        """Sends a GET request, returning an HTTP_Response.
+        """
+        return self.request("GET", url, headers=headers)
+
+    def request(self, method, url, data=None, headers=None):
+        """Sends a request over an idle connection to the host if there is one,
+        returning an HTTP_Response.
+        """
+        scheme, host, port, path = self._split_url(url)
+        idle = self._idle.setdefault((scheme, host, port), [])
+        while True:
+            reused = bool(idle)
+            connection = idle.pop() if reused else self._connection(scheme, host, port)
+            try:
+                connection.request(method, path, body=data, headers=headers or {})
+                response = connection.getresponse()
+                content = response.read()
+                break
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                # The server may have closed an idle connection, try a new one
+                if not reused:
+                    raise
+        self.requests += 1
+        if response.will_close or len(idle) >= self.max_connections:
+            connection.close()
+        else:
+            idle.append(connection)
+        return HTTP_Response(
+            response.status, {name.lower(): value for name, value in response.getheaders()},
+            content)
+
+    def close(self):
+        """Closes every idle connection.
+        """
+        for idle in self._idle.values():
+            for connection in idle:
+                connection.close()
+        self._idle = {}
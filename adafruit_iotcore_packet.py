@@ -0,0 +1,153 @@
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Modified by Brent Rubell for Adafruit Industries, 2019
+"""
+`adafruit_iotcore_packet`
+================================================================================
+
+MQTT packet encoding shared by MQTT_API and AsyncMQTT_API, and the writer
+MQTT_API publishes bytes, bytearray and memoryview payloads with. Imported
+by MQTT_API when it first publishes a binary payload.
+
+* Author(s): Brent Rubell, Google Inc.
+
+Implementation Notes
+--------------------
+
+**Software and Dependencies:**
+
+* Adafruit CircuitPython firmware for the supported boards:
+  https://github.com/adafruit/circuitpython/releases
+
+"""
+import struct
+
+__version__ = "0.0.0-auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_Cloud_IOT_Core.git"
+
+
+def _byte_view(payload):
+    """Returns a bytearray or memoryview payload as a buffer whose length is its
+    size in bytes, casting memoryviews of wider items, such as of an array of floats.
+    """
+    if isinstance(payload, memoryview) and getattr(payload, "itemsize", 1) != 1:
+        if hasattr(payload, "cast"):
+            return payload.cast("B")
+        return bytes(payload)
+    return payload
+
+
+def _mqtt_string(value):
+    """Returns a length-prefixed MQTT string.
+    """
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return struct.pack(">H", len(value)) + value
+
+
+def _mqtt_header(packet_type, length):
+    """Returns an MQTT fixed header, the packet type and remaining length.
+    """
+    header = bytearray((packet_type,))
+    while True:
+        byte = length % 128
+        length //= 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(header)
+
+
+def _mqtt_packet(packet_type, body):
+    """Returns an MQTT packet with its fixed header and remaining length.
+    """
+    return _mqtt_header(packet_type, len(body)) + body
+
+
+# pylint: disable=protected-access
+class Packet_Writer:
+    """Publishes bytes, bytearray and memoryview payloads, which MiniMQTT doesn't
+    accept, by writing PUBLISH packets to a MiniMQTT client's socket. Headers are
+    cached for each topic, QoS and payload length so that nothing is allocated
+    for a repeated QoS 0 message. QoS 1 messages take the client's next packet
+    id and, as with MiniMQTT's publish, wait for their PUBACK.
+
+    :param MiniMQTT mqtt_client: MiniMQTT Client object.
+    :param int cache_size: Most topics whose headers are cached, the cache is
+        cleared once it is full.
+    """
+
+    def __init__(self, mqtt_client, cache_size=16):
+        self._client = mqtt_client
+        self.cache_size = cache_size
+        # PUBLISH headers, as (payload length, qos, header) keyed by topic
+        self._headers = {}
+
+    def publish(self, mqtt_topic, payload, qos=0):
+        """Publishes a binary payload to a full MQTT topic, returning its packet
+        id, or 0 for a QoS 0 message.
+        """
+        # The remaining length counts bytes, not the elements of a typed memoryview
+        payload = _byte_view(payload)
+        length = len(payload)
+        header = self._headers.get(mqtt_topic, None)
+        if header is None or header[0] != length or header[1] != qos:
+            topic = _mqtt_string(mqtt_topic)
+            # A QoS 1 message's packet id follows the topic
+            remaining = len(topic) + (2 if qos else 0) + length
+            header = (length, qos, _mqtt_header(0x30 | qos << 1, remaining) + topic)
+            if len(self._headers) >= self.cache_size:
+                self._headers.clear()
+            self._headers[mqtt_topic] = header
+        self._write(header[2])
+        if not qos:
+            self._write(payload)
+            return 0
+        # Packet ids are shared with MiniMQTT's, and run from 1 to 65535
+        self._client._pid = self._client._pid % 65535 + 1
+        packet_id = self._client._pid
+        self._write(struct.pack(">H", packet_id))
+        self._write(payload)
+        self._wait_for_puback(packet_id)
+        return packet_id
+
+    def _wait_for_puback(self, packet_id):
+        """Handles inbound packets until the PUBACK for packet_id arrives, as
+        MiniMQTT's publish does for QoS 1 messages.
+        """
+        client = self._client
+        while True:
+            if client._wait_for_msg() == 0x40:
+                # PUBACK's remaining length, always 2, then its packet id
+                client._sock.recv(1)
+                ack = client._sock.recv(2)
+                if ack[0] << 8 | ack[1] == packet_id:
+                    return
+
+    def _write(self, data):
+        """Writes all of data to the client's socket, sending the rest again
+        after a short write, which would otherwise corrupt the MQTT stream.
+        """
+        sock = self._client._sock
+        if hasattr(sock, "sendall"):
+            sock.sendall(data)
+            return
+        while True:
+            sent = sock.send(data)
+            # Sockets which always write everything, such as ESP32SPI's, may return None
+            if sent is None or sent >= len(data):
+                return
+            if not sent:
+                raise OSError("Connection closed while publishing.")
+            data = memoryview(data)[sent:]
@@ -0,0 +1,427 @@
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Modified by Brent Rubell for Adafruit Industries, 2019
+"""
+`adafruit_iotcore_queue`
+================================================================================
+
+Outbound flow control for MQTT_API: rate limits, the store-and-forward
+Outbox and priority queues. Kept apart from adafruit_iotcore so that
+devices only load the features they use.
+
+* Author(s): Brent Rubell, Google Inc.
+
+Implementation Notes
+--------------------
+
+**Software and Dependencies:**
+
+* Adafruit CircuitPython firmware for the supported boards:
+  https://github.com/adafruit/circuitpython/releases
+
+"""
+import os
+import struct
+import time
+
+from adafruit_iotcore import _is_connection_error, _ticks_us
+
+__version__ = "0.0.0-auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_Cloud_IOT_Core.git"
+
+# Outbox file record header: QoS, topic length and payload length
+OUTBOX_HEADER = ">BHI"
+OUTBOX_HEADER_SIZE = 7
+
+
+class Token_Bucket:
+    """Token bucket allowing rate messages per second on average, in bursts of
+    up to burst messages.
+
+    :param float rate: Tokens added per second.
+    :param int burst: Most tokens held by the bucket.
+    :param clock: Optional function returning the time in seconds, defaults to
+        time.monotonic. A fake clock can be provided for testing.
+    """
+
+    def __init__(self, rate, burst=1, clock=None):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock or time.monotonic
+        self._tokens = burst
+        self._time = self._clock()
+
+    def _refill(self):
+        """Adds the tokens accrued since the bucket was last refilled.
+        """
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._time) * self.rate)
+        self._time = now
+
+    def take(self):
+        """Takes a token, returns False if the bucket is empty.
+        """
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    @property
+    def wait_time(self):
+        """Returns the number of seconds until a token is available.
+        """
+        self._refill()
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+class Rate_Limiter:
+    """Limits MQTT_API's publish rate with separate token buckets for device
+    telemetry (events) and state messages, to stay within IoT Core's
+    per-device quotas (https://cloud.google.com/iot/quotas).
+
+    :param Token_Bucket events: Bucket for events messages, defaults to 100 per second.
+    :param Token_Bucket state: Bucket for state messages, defaults to 1 per second.
+    :param bool blocking: If True, publishing waits for a token. Otherwise a message
+        without a token is queued in MQTT_API's outbox, if it has one, or dropped
+        with publish returning False.
+
+    Example of limiting telemetry to 10 messages per second:
+    ..code-block:: python
+
+        google_mqtt.rate_limiter = Rate_Limiter(events=Token_Bucket(10, burst=20))
+
+    """
+
+    def __init__(self, events=None, state=None, blocking=False):
+        self.events = events or Token_Bucket(100, 100)
+        self.state = state or Token_Bucket(1, 1)
+        self.blocking = blocking
+        self.limited = 0
+
+    def bucket(self, mqtt_topic):
+        """Returns the token bucket for a full MQTT topic.
+        """
+        return self.state if mqtt_topic.endswith("/state") else self.events
+
+    def acquire(self, mqtt_topic):
+        """Takes a token for a message to a full MQTT topic. Returns False
+        if there is none and the limiter is not blocking.
+
+        :param str mqtt_topic: Full MQTT topic of the message.
+        """
+        bucket = self.bucket(mqtt_topic)
+        if bucket.take():
+            return True
+        if self.blocking:
+            while not bucket.take():
+                time.sleep(bucket.wait_time)
+            return True
+        self.limited += 1
+        return False
+
+
+# pylint: disable=too-many-instance-attributes
+class Outbox:
+    """Store-and-forward queue for messages published while MQTT_API is
+    disconnected. Messages are kept in a fixed-size ring buffer and, optionally,
+    appended to a file once the ring is full. Queued messages are re-published
+    from MQTT_API's loop once it has reconnected, at most drain_rate per call.
+
+    The file holds length-prefixed records and is only removed once every record
+    in it has been sent, so messages queued before a reset are sent after it.
+    CircuitPython's filesystem must be writable by code to use a file.
+
+    :param int size: Number of messages kept in memory.
+    :param int policy: Outbox.DROP_OLDEST or Outbox.DROP_NEWEST, the message
+        dropped when the queue is full. The file can only be appended to, so once
+        messages are queued in it, new messages are dropped when it is full
+        whatever the policy.
+    :param str path: Optional file to queue messages in once the ring buffer is full.
+    :param int max_file_size: Largest size of the file, in bytes. Once reached,
+        new messages are dropped.
+    :param int drain_rate: Most messages re-published per call to MQTT_API's loop.
+
+    Example of queueing messages while disconnected:
+    ..code-block:: python
+
+        google_mqtt.outbox = Outbox(size=32, path="/outbox.bin")
+
+    """
+
+    DROP_OLDEST = 0
+    DROP_NEWEST = 1
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, size=16, policy=DROP_OLDEST, path=None, max_file_size=65536,
+                 drain_rate=8):
+        if size < 1:
+            raise ValueError("size must be at least 1.")
+        self._ring = [None] * size
+        self._head = 0
+        self._count = 0
+        self.policy = policy
+        self.drain_rate = drain_rate
+        self._path = path
+        self.max_file_size = max_file_size
+        self._header = bytearray(OUTBOX_HEADER_SIZE)
+        self._reader = None
+        self._next = None
+        self._read_offset = 0
+        self._file_size = 0
+        self._file_records = 0
+        if path is not None:
+            self._scan_file()
+        self.dropped = 0
+        self.sent = 0
+        # Messages dropped because publishing them failed for a reason other
+        # than the connection, such as being too large
+        self.failed = 0
+
+    def __len__(self):
+        return self._count + self._file_records
+
+    def put(self, topic, payload, qos=0):
+        """Queues a message for a full MQTT topic.
+
+        :param str topic: Full MQTT topic.
+        :param payload: Data to publish, as a str, bytes, int or float.
+        :param int qos: Quality of Service level for the message.
+        """
+        # Messages go to the file once it is in use, to keep them in order
+        if self._file_records == 0 and self._count < len(self._ring):
+            self._ring[(self._head + self._count) % len(self._ring)] = (topic, payload, qos)
+            self._count += 1
+        elif self._path is not None and self._append(topic, payload, qos):
+            self._file_records += 1
+        elif self.policy == Outbox.DROP_OLDEST and self._file_records == 0:
+            # Overwrite the oldest message in the ring
+            self._ring[self._head] = (topic, payload, qos)
+            self._head = (self._head + 1) % len(self._ring)
+            self.dropped += 1
+        else:
+            self.dropped += 1
+
+    def drain(self, publish, count=None, limiter=None):
+        """Publishes up to count queued messages, oldest first, defaulting to
+        drain_rate messages. Returns the number of messages published. A message
+        which fails to publish other than because of the connection is dropped
+        and counted in failed, a connection error is raised.
+
+        :param publish: Function called with the topic, payload and qos keyword to
+            publish each message, such as a MiniMQTT client's publish. MQTT_API passes
+            its own, which also publishes bytes payloads.
+        :param int count: Most messages to publish.
+        :param Rate_Limiter limiter: Optional rate limiter, draining stops
+            when it has no tokens left.
+        """
+        if count is None:
+            count = self.drain_rate
+        sent = 0
+        while sent < count and self._count:
+            topic, payload, qos = self._ring[self._head] # pylint: disable=unpacking-non-sequence
+            if limiter is not None and not limiter.bucket(topic).take():
+                break
+            published = self._publish(publish, topic, payload, qos)
+            self._ring[self._head] = None
+            self._head = (self._head + 1) % len(self._ring)
+            self._count -= 1
+            sent += published
+        while sent < count and self._count == 0 and self._file_records:
+            # Read ahead, the record is kept if it can't be sent yet
+            if self._next is None:
+                self._next = self._read()
+            topic, payload, qos = self._next
+            if limiter is not None and not limiter.bucket(topic).take():
+                break
+            published = self._publish(publish, topic, payload, qos)
+            self._next = None
+            self._file_records -= 1
+            sent += published
+        if self._reader is not None and self._file_records == 0:
+            # Every record in the file has been sent
+            self._reader.close()
+            self._reader = None
+            os.remove(self._path)
+            self._read_offset = 0
+            self._file_size = 0
+        self.sent += sent
+        return sent
+
+    def _publish(self, publish, topic, payload, qos):
+        """Publishes a queued message, returns 1 if it was sent and 0 if it was
+        dropped. Connection errors are raised, keeping the message queued.
+        """
+        try:
+            publish(topic, payload, qos=qos)
+        except Exception as error: # pylint: disable=broad-except
+            if _is_connection_error(error):
+                raise
+            # Sending it again would fail again, holding up every message behind it
+            self.failed += 1
+            return 0
+        return 1
+
+    def _append(self, topic, payload, qos):
+        """Appends a message to the file, returns False if it would not fit.
+        """
+        if isinstance(payload, (int, float)):
+            payload = str(payload)
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        topic = topic.encode("utf-8")
+        size = OUTBOX_HEADER_SIZE + len(topic) + len(payload)
+        if self._file_size + size > self.max_file_size:
+            return False
+        struct.pack_into(OUTBOX_HEADER, self._header, 0, qos, len(topic), len(payload))
+        with open(self._path, "ab") as outbox_file:
+            outbox_file.write(self._header)
+            outbox_file.write(topic)
+            outbox_file.write(payload)
+        self._file_size += size
+        return True
+
+    def _read(self):
+        """Reads the next message from the file.
+        """
+        if self._reader is None:
+            self._reader = open(self._path, "rb")
+            self._reader.seek(self._read_offset)
+        self._reader.readinto(self._header)
+        qos, topic_length, payload_length = struct.unpack_from(OUTBOX_HEADER, self._header)
+        topic = self._reader.read(topic_length).decode("utf-8")
+        payload = self._reader.read(payload_length)
+        self._read_offset += OUTBOX_HEADER_SIZE + topic_length + payload_length
+        return topic, payload, qos
+
+    def _scan_file(self):
+        """Counts the records in a file left over from before a reset.
+        """
+        try:
+            outbox_file = open(self._path, "rb")
+        except OSError:
+            return
+        with outbox_file:
+            while outbox_file.readinto(self._header) == OUTBOX_HEADER_SIZE:
+                _, topic_length, payload_length = struct.unpack_from(
+                    OUTBOX_HEADER, self._header
+                )
+                outbox_file.seek(topic_length + payload_length, 1)
+                self._file_size += OUTBOX_HEADER_SIZE + topic_length + payload_length
+                self._file_records += 1
+
+
+class Priority_Scheduler:
+    """Queues MQTT_API's outbound messages in priority classes, so that a flood
+    of telemetry can't hold up alarms or state messages. Each class has its own
+    bounded Outbox and drop policy. MQTT_API's loop() sends queued messages,
+    highest priority first, for up to budget seconds per call so that inbound
+    messages are still handled promptly. While disconnected, or once a class's
+    rate_limiter bucket is empty, messages wait in their queues.
+
+    :param float budget: Most time spent sending per call to loop(), in seconds.
+
+    Example of sending alarms and state ahead of telemetry:
+    ..code-block:: python
+
+        scheduler = Priority_Scheduler(budget=0.02)
+        scheduler.add_class("alarm", 8, Outbox.DROP_NEWEST, topics=("events/alarm",))
+        scheduler.add_class("state", 1, topics=("state",))
+        scheduler.add_class("telemetry", 64)
+        google_mqtt.scheduler = scheduler
+
+    """
+
+    def __init__(self, budget=0.01):
+        self.budget = budget
+        # [name, queue, topic suffixes, peak depth], highest priority first
+        self._classes = []
+        self._by_name = {}
+
+    def __len__(self):
+        return sum(len(priority_class[1]) for priority_class in self._classes)
+
+    def add_class(self, name, size=16, policy=Outbox.DROP_OLDEST, topics=()):
+        """Adds a priority class below the classes already added. The lowest
+        class also takes messages which don't match any class's topics.
+
+        :param str name: Name of the class.
+        :param int size: Most messages queued in the class.
+        :param int policy: Outbox.DROP_OLDEST or Outbox.DROP_NEWEST, the message
+            dropped when the class's queue is full.
+        :param tuple topics: Topics relative to the device, such as "state" or
+            "events/alarm", whose messages belong to the class.
+        """
+        priority_class = [name, Outbox(size, policy), tuple("/" + topic for topic in topics), 0]
+        self._classes.append(priority_class)
+        self._by_name[name] = priority_class
+
+    def classify(self, mqtt_topic):
+        """Returns the name of the class for a full MQTT topic.
+        """
+        if not self._classes:
+            raise ValueError("Priority_Scheduler has no classes, add them with add_class.")
+        for priority_class in self._classes:
+            for suffix in priority_class[2]:
+                if mqtt_topic.endswith(suffix):
+                    return priority_class[0]
+        return self._classes[-1][0]
+
+    def put(self, mqtt_topic, payload, qos=0, priority=None):
+        """Queues a message, returns False if it was dropped.
+
+        :param str priority: Name of the message's class, defaults to the class
+            matching mqtt_topic.
+        """
+        if priority is None:
+            priority = self.classify(mqtt_topic)
+        priority_class = self._by_name.get(priority, None)
+        if priority_class is None:
+            raise ValueError("Priority class {} was not added.".format(priority))
+        queue = priority_class[1]
+        dropped = queue.dropped
+        queue.put(mqtt_topic, payload, qos)
+        if len(queue) > priority_class[3]:
+            priority_class[3] = len(queue)
+        return queue.dropped == dropped or queue.policy == Outbox.DROP_OLDEST
+
+    def drain(self, publish, limiter=None):
+        """Publishes queued messages, highest priority first, until every queue is
+        empty or budget seconds have passed. Returns the number of messages published.
+
+        :param publish: Function publishing each message, see Outbox.drain.
+        :param Rate_Limiter limiter: Optional rate limiter, a class is skipped
+            once its messages have no tokens left.
+        """
+        deadline = _ticks_us() + int(self.budget * 1000000)
+        sent = 0
+        for priority_class in self._classes:
+            queue = priority_class[1]
+            while queue:
+                if not queue.drain(publish, 1, limiter):
+                    break
+                sent += 1
+                if _ticks_us() >= deadline:
+                    return sent
+        return sent
+
+    def snapshot(self):
+        """Returns [queued, peak queued, dropped, sent] keyed by class name, where
+        dropped includes messages which failed to publish.
+        """
+        return {name: [len(queue), peak, queue.dropped + queue.failed, queue.sent]
+                for name, queue, _, peak in self._classes}
@@ -0,0 +1,434 @@
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Modified by Brent Rubell for Adafruit Industries, 2019
+"""
+`adafruit_iotcore_routing`
+================================================================================
+
+Inbound message handling for MQTT_API: topic routes, gateways, duplicate
+suppression and device configuration. Kept apart from adafruit_iotcore so
+that devices only load the features they use.
+
+* Author(s): Brent Rubell, Google Inc.
+
+Implementation Notes
+--------------------
+
+**Software and Dependencies:**
+
+* Adafruit CircuitPython firmware for the supported boards:
+  https://github.com/adafruit/circuitpython/releases
+
+"""
+import json
+import time
+
+__version__ = "0.0.0-auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_Cloud_IOT_Core.git"
+
+
+class Command_Router:
+    """Dispatches inbound messages to handlers registered for device topic
+    patterns, such as "commands/reset", "commands/+/set" or "commands/#".
+    Patterns are kept in a trie of topic levels, so dispatching a message costs
+    the depth of its topic rather than the number of registered handlers.
+
+    Handlers are called with the MQTT_API object, the full topic and the payload,
+    like MQTT_API's on_message callback.
+    """
+
+    def __init__(self):
+        # Each node is a tuple of its children, keyed by topic level, and its handlers
+        self._root = ({}, [])
+
+    def add(self, pattern, handler):
+        """Registers a handler for a device topic pattern.
+
+        :param str pattern: Topic, relative to the device, which may contain the
+            MQTT wildcards + (one level) and # (any remaining levels).
+        :param handler: Function called with (mqtt_api, topic, payload).
+        """
+        levels = pattern.split("/")
+        if "#" in levels[:-1]:
+            raise ValueError("# must be the last level of a pattern.")
+        node = self._root
+        for level in levels:
+            child = node[0].get(level, None)
+            if child is None:
+                child = ({}, [])
+                node[0][level] = child
+            node = child
+        node[1].append(handler)
+
+    def remove(self, pattern, handler=None):
+        """Removes a handler, or all handlers if handler is None, from a device topic pattern.
+        """
+        node = self._root
+        for level in pattern.split("/"):
+            node = node[0].get(level, None)
+            if node is None:
+                return
+        if handler is None:
+            node[1].clear()
+        elif handler in node[1]:
+            node[1].remove(handler)
+
+    def dispatch(self, mqtt_api, topic, payload, device_topic):
+        """Calls the handlers matching a message, returns how many were called.
+
+        :param MQTT_API mqtt_api: MQTT_API object passed to handlers.
+        :param str topic: Full MQTT topic of the message.
+        :param payload: Message payload.
+        :param str device_topic: Topic relative to the device, such as "commands/reset".
+        """
+        return self._dispatch(self._root, device_topic.split("/"), 0, mqtt_api, topic, payload)
+
+    # pylint: disable=too-many-arguments
+    def _dispatch(self, node, levels, depth, mqtt_api, topic, payload):
+        """Calls the handlers of node and its children matching levels[depth:].
+        """
+        called = 0
+        children = node[0]
+        # "#" also matches the parent level itself
+        wildcard = children.get("#", None)
+        if wildcard is not None:
+            for handler in wildcard[1]:
+                handler(mqtt_api, topic, payload)
+                called += 1
+        if depth == len(levels):
+            for handler in node[1]:
+                handler(mqtt_api, topic, payload)
+                called += 1
+            return called
+        child = children.get(levels[depth], None)
+        if child is not None:
+            called += self._dispatch(child, levels, depth + 1, mqtt_api, topic, payload)
+        child = children.get("+", None)
+        if child is not None:
+            called += self._dispatch(child, levels, depth + 1, mqtt_api, topic, payload)
+        return called
+
+
+class Gateway:
+    """Publishes and receives messages for many devices bound to an IoT Core
+    gateway, over the gateway's MQTT_API connection. Devices are attached the
+    first time they publish, or explicitly with attach() to receive their
+    configuration and commands (https://cloud.google.com/iot/docs/how-tos/gateways/mqtt-bridge).
+
+    :param MQTT_API mqtt_api: The gateway device's MQTT_API object.
+
+    Example of publishing for a bound device:
+    ..code-block:: python
+
+        gateway = Gateway(google_mqtt)
+        gateway.add_route("+", "commands/#", device_command)
+        gateway.attach("sensor-1")
+        gateway.publish("sensor-2", 21.5)
+
+    """
+
+    # Bound devices' messages go through the gateway's MQTT_API and MiniMQTT client
+    # pylint: disable=protected-access
+
+    def __init__(self, mqtt_api):
+        self._mqtt = mqtt_api
+        mqtt_api.gateway = self
+        # Attached devices, as [topic prefix, topic cache, subscribed, authorization]
+        self._devices = {}
+        self.router = Command_Router()
+        self.attaches = 0
+
+    @staticmethod
+    def device_id(topic):
+        """Returns the device id of a full MQTT topic, such as one passed to a handler.
+        """
+        return topic.split("/")[2]
+
+    @property
+    def devices(self):
+        """Returns the ids of the attached devices.
+        """
+        return list(self._devices)
+
+    def attach(self, device_id, authorization=None, subscribe=True):
+        """Attaches a bound device to the gateway.
+
+        :param str device_id: Id of the bound device.
+        :param str authorization: Optional JWT for the device, not needed if the
+            gateway's authentication method is association only.
+        :param bool subscribe: Subscribes to the device's config and commands topics.
+        """
+        device = self._devices.get(device_id, None)
+        if device is None:
+            device = ["/devices/{}/".format(device_id), {}, subscribe, authorization]
+            self._devices[device_id] = device
+        else:
+            device[2] = subscribe
+            device[3] = authorization
+        if self._mqtt.is_connected:
+            self._attach(device)
+
+    def _attach(self, device):
+        """Publishes a device's attach message and subscribes to its topics.
+        """
+        if device[3] is not None:
+            payload = json.dumps({"authorization": device[3]})
+        else:
+            payload = ""
+        self._mqtt._client.publish(device[0] + "attach", payload, qos=1)
+        if device[2]:
+            self._mqtt._client.subscribe(device[0] + "config", 1)
+            self._mqtt._client.subscribe(device[0] + "commands/#", 1)
+        self.attaches += 1
+
+    def detach(self, device_id):
+        """Detaches a bound device from the gateway, unsubscribing from its
+        config and commands topics.
+        """
+        device = self._devices.pop(device_id, None)
+        if device is not None and self._mqtt.is_connected:
+            if device[2]:
+                self._mqtt._client.unsubscribe(device[0] + "config")
+                self._mqtt._client.unsubscribe(device[0] + "commands/#")
+            self._mqtt._client.publish(device[0] + "detach", "", qos=1)
+
+    def reset(self):
+        """Attaches every known device again, called when the gateway (re)connects.
+        """
+        for device in self._devices.values():
+            self._attach(device)
+
+    def _topic(self, device_id, topic, subfolder=None):
+        """Returns the full MQTT topic for a bound device, attaching it first if needed.
+        """
+        device = self._devices.get(device_id, None)
+        if device is None:
+            self.attach(device_id, subscribe=False)
+            device = self._devices[device_id]
+        key = (topic, subfolder)
+        mqtt_topic = device[1].get(key, None)
+        if mqtt_topic is None:
+            if subfolder is not None:
+                mqtt_topic = "{}{}/{}".format(device[0], topic, subfolder)
+            else:
+                mqtt_topic = device[0] + topic
+            if len(device[1]) >= self._mqtt.topic_cache_size:
+                device[1].clear()
+            device[1][key] = mqtt_topic
+        return mqtt_topic
+
+    # pylint: disable=too-many-arguments
+    def publish(self, device_id, payload, topic="events", subfolder=None, qos=0):
+        """Publishes a payload for a bound device, defaults to the "events" topic.
+        The gateway's codec and rate_limiter, if set, apply.
+
+        :param str device_id: Id of the bound device.
+        :param payload: Data to publish.
+        :param str topic: Required MQTT topic. Defaults to events.
+        :param str subfolder: Optional MQTT topic subfolder. Defaults to None.
+        :param int qos: Quality of Service level for the message.
+        """
+        if topic == "state" and subfolder is not None:
+            raise ValueError("Subfolders are not supported for state messages.")
+        if self._mqtt.codec is not None:
+            payload = self._mqtt.codec.encode(payload)
+        return self._mqtt._send(self._topic(device_id, topic, subfolder), payload, qos)
+
+    def publish_state(self, device_id, payload):
+        """Publishes a device state message for a bound device.
+        """
+        return self.publish(device_id, payload, "state")
+
+    def add_route(self, device_id, pattern, handler):
+        """Calls handler for a bound device's messages to a topic pattern.
+
+        :param str device_id: Id of the bound device, or + for every device.
+        :param str pattern: Topic, relative to the device, such as "config" or "commands/#".
+        :param handler: Function called with (gateway, topic, payload).
+        """
+        self.router.add(device_id + "/" + pattern, handler)
+
+    def remove_route(self, device_id, pattern, handler=None):
+        """Removes a handler, or all handlers if handler is None, from a bound device's pattern.
+        """
+        self.router.remove(device_id + "/" + pattern, handler)
+
+    def dispatch(self, topic, payload):
+        """Calls the handlers for a message to an attached device, returns how
+        many were called.
+        """
+        # Strip "/devices/", leaving "<device id>/<topic>"
+        device_topic = topic[9:]
+        if device_topic[:device_topic.find("/")] not in self._devices:
+            return 0
+        return self.router.dispatch(self, topic, payload, device_topic)
+
+
+class Duplicate_Filter:
+    """Suppresses inbound messages redelivered by the broker, such as QoS 1 commands
+    sent again before their PUBACK arrived, so that handlers don't run twice.
+    Messages are identified by a hash of their topic and payload and remembered
+    for window seconds, up to size messages, after which the message which
+    arrived first is forgotten. An identical command sent on purpose within the
+    window is also suppressed.
+
+    :param int size: Most messages remembered.
+    :param int window: Seconds a message is remembered for.
+
+    Example of suppressing duplicate commands:
+    ..code-block:: python
+
+        google_mqtt.duplicate_filter = Duplicate_Filter(size=16, window=30)
+
+    """
+
+    def __init__(self, size=32, window=60):
+        self.size = size
+        self.window = window
+        # Arrival time, in whole seconds, keyed by message hash
+        self._seen = {}
+        # Ring of message hashes in order of arrival, as dicts aren't ordered
+        # on CircuitPython, the oldest at _next once the ring is full
+        self._keys = [None] * size
+        self._next = 0
+        self.checks = 0
+        self.hits = 0
+
+    @property
+    def hit_rate(self):
+        """Returns the fraction of checked messages which were duplicates.
+        """
+        return self.hits / self.checks if self.checks else 0
+
+    def seen(self, topic, payload):
+        """Returns True if an identical message arrived within window seconds,
+        otherwise remembers the message and returns False.
+        """
+        # Masked to stay a small int, which CircuitPython doesn't allocate
+        key = (hash(topic) * 31 + hash(payload)) & 0x3FFFFFFF
+        now = int(time.monotonic())
+        self.checks += 1
+        arrived = self._seen.get(key, None)
+        if arrived is not None:
+            # Repeats keep the first arrival time, so they don't extend the window
+            if now - arrived <= self.window:
+                self.hits += 1
+                return True
+            # Arrived again after the window, so remembered as a new message
+            self._keys[self._keys.index(key)] = None
+        oldest = self._keys[self._next]
+        if oldest is not None:
+            del self._seen[oldest]
+        self._keys[self._next] = key
+        self._next = (self._next + 1) % len(self._keys)
+        self._seen[key] = now
+        return False
+
+    def clear(self):
+        """Forgets every message.
+        """
+        self._seen = {}
+        self._keys = [None] * self.size
+        self._next = 0
+
+
+class Device_Config:
+    """Caches the device configuration sent by IoT Core on the config topic.
+    QoS 1 redelivers configurations, so a configuration identical to the last
+    one applied is ignored. Configurations are only parsed when a field is
+    first accessed and, if a path is provided, are saved to a file so the last
+    configuration is available immediately after a reset. CircuitPython's
+    filesystem must be writable by code to use a file.
+
+    :param str path: Optional file to keep the last configuration in.
+    :param parser: Function parsing configuration bytes, defaults to json.loads.
+
+    Example of using a cached configuration:
+    ..code-block:: python
+
+        def config_changed(client, config):
+            print("Sample rate:", config.get("sample_rate"))
+
+        google_mqtt.config = Device_Config(path="/config.json")
+        google_mqtt.on_config = config_changed
+        google_mqtt.subscribe_to_config()
+
+    """
+
+    def __init__(self, path=None, parser=None):
+        self._path = path
+        self._parser = parser or json.loads
+        self._payload = None
+        self._digest = None
+        self._data = None
+        self.updates = 0
+        self.duplicates = 0
+        if path is not None:
+            try:
+                with open(path, "rb") as config_file:
+                    self._set(config_file.read())
+            except OSError:
+                pass
+
+    def _set(self, payload):
+        """Stores a configuration, to be parsed when it is next accessed.
+        """
+        self._payload = payload
+        self._digest = hash(payload)
+        self._data = None
+
+    def update(self, payload):
+        """Applies a configuration received from IoT Core. Returns False if it is
+        identical to the current configuration.
+
+        :param payload: Configuration, as bytes or str.
+        """
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if hash(payload) == self._digest and payload == self._payload:
+            self.duplicates += 1
+            return False
+        self._set(payload)
+        self.updates += 1
+        if self._path is not None:
+            with open(self._path, "wb") as config_file:
+                config_file.write(payload)
+        return True
+
+    @property
+    def payload(self):
+        """Returns the current configuration as bytes, or None if there is none.
+        """
+        return self._payload
+
+    @property
+    def data(self):
+        """Returns the parsed current configuration, parsing it on first access.
+        """
+        if self._data is None:
+            if self._payload:
+                self._data = self._parser(self._payload)
+            else:
+                # IoT Core sends an empty configuration to devices without one
+                self._data = {}
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def get(self, key, default=None):
+        """Returns a field of the current configuration, or default if it is not set.
+        """
+        return self.data.get(key, default)
@@ -0,0 +1,442 @@
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Modified by Brent Rubell for Adafruit Industries, 2019
+"""
+`adafruit_iotcore_telemetry`
+================================================================================
+
+Telemetry helpers for MQTT_API: client metrics, batched publishing and
+windowed sensor aggregation. Kept apart from adafruit_iotcore so that
+devices only load the features they use.
+
+* Author(s): Brent Rubell, Google Inc.
+
+Implementation Notes
+--------------------
+
+**Software and Dependencies:**
+
+* Adafruit CircuitPython firmware for the supported boards:
+  https://github.com/adafruit/circuitpython/releases
+
+"""
+import array
+import time
+
+from adafruit_iotcore import _encode_dict
+from adafruit_iotcore_packet import _byte_view
+
+__version__ = "0.0.0-auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_Cloud_IOT_Core.git"
+
+# Largest telemetry payload accepted by IoT Core, in bytes
+MAX_TELEMETRY_PAYLOAD = 262144
+
+# Upper bounds of Histogram's buckets, in microseconds
+HISTOGRAM_BOUNDS = (100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 1000000)
+
+
+class Histogram:
+    """Fixed-size histogram of durations, in microseconds.
+
+    :param tuple bounds: Upper bound of each bucket, in ascending order. Durations
+        above the last bound are counted in an extra overflow bucket.
+    """
+
+    def __init__(self, bounds=HISTOGRAM_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, duration):
+        """Counts a duration, in microseconds.
+        """
+        index = 0
+        for bound in self.bounds:
+            if duration <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def reset(self):
+        """Clears all counts.
+        """
+        for index, _ in enumerate(self.counts):
+            self.counts[index] = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def snapshot(self):
+        """Returns [count, mean, max, bucket counts], with times in microseconds.
+        """
+        mean = self.total // self.count if self.count else 0
+        return [self.count, mean, self.max, list(self.counts)]
+
+
+class Metrics:
+    """Counters and latency histograms for MQTT_API, using a fixed amount of memory.
+    Records publish counts and bytes per topic, loop() and inbound message dispatch
+    durations, reconnects, JWT refreshes and time sync latency.
+
+    :param int interval: If set, MQTT_API's loop() publishes a snapshot of the
+        metrics to the "events/metrics" topic every interval seconds.
+    :param int max_topics: Most topics counted separately, publishes to any
+        further topics are counted under "other".
+
+    Example of publishing metrics every 10 minutes:
+    ..code-block:: python
+
+        metrics = Metrics(interval=600)
+        google_mqtt.metrics = metrics
+        cloud_core.time_sync.metrics = metrics
+
+    """
+
+    def __init__(self, interval=None, max_topics=8):
+        self.interval = interval
+        self.max_topics = max_topics
+        # [messages, bytes] keyed by full MQTT topic
+        self.published = {}
+        self.loop_time = Histogram()
+        self.dispatch_time = Histogram()
+        self.sync_latency = Histogram()
+        self.connects = 0
+        self.jwt_refreshes = 0
+        self._snapshot_time = time.monotonic()
+
+    @property
+    def reconnects(self):
+        """Returns the number of connections after the first.
+        """
+        return max(self.connects - 1, 0)
+
+    def record_publish(self, topic, payload):
+        """Counts a message published, or queued for publishing, to a full MQTT topic.
+        """
+        counts = self.published.get(topic)
+        if counts is None:
+            if len(self.published) >= self.max_topics:
+                topic = "other"
+            counts = self.published.setdefault(topic, [0, 0])
+        counts[0] += 1
+        if isinstance(payload, (int, float)):
+            payload = str(payload)
+        elif isinstance(payload, str):
+            # Counted as published, in bytes rather than characters
+            payload = payload.encode("utf-8")
+        elif isinstance(payload, memoryview):
+            payload = _byte_view(payload)
+        counts[1] += len(payload)
+
+    @property
+    def due(self):
+        """Returns True if interval is set and has passed since the last snapshot.
+        """
+        return (self.interval is not None
+                and time.monotonic() - self._snapshot_time >= self.interval)
+
+    def reset(self):
+        """Clears all counts and histograms.
+        """
+        self.published = {}
+        for histogram in (self.loop_time, self.dispatch_time, self.sync_latency):
+            histogram.reset()
+        self.connects = 0
+
+    def snapshot(self, prefix=""):
+        """Returns the metrics as a dict of compact values, for publishing.
+        Publish counts are keyed by topic with prefix removed, and histograms
+        are given as [count, mean, max, bucket counts] in microseconds.
+
+        :param str prefix: Topic prefix, such as "/devices/<device_id>/".
+        """
+        self._snapshot_time = time.monotonic()
+        published = {}
+        for topic, counts in self.published.items():
+            if topic.startswith(prefix):
+                topic = topic[len(prefix):]
+            published[topic] = counts
+        return {
+            "pub": published,
+            "loop": self.loop_time.snapshot(),
+            "dispatch": self.dispatch_time.snapshot(),
+            "sync": self.sync_latency.snapshot(),
+            "reconnects": self.reconnects,
+            "jwt": self.jwt_refreshes,
+        }
+
+
+class Batch_Publisher:
+    """Coalesces small telemetry records into larger event payloads, so fewer
+    MQTT messages are published for the same data. Records are buffered per
+    (topic, subfolder) and each buffer is published as one message once it holds
+    max_records records, would grow beyond max_bytes bytes, or its oldest record
+    is max_latency seconds old.
+
+    :param MQTT_API mqtt_api: MQTT_API object to publish with.
+    :param int max_records: Maximum number of records in one message.
+    :param int max_bytes: Maximum size of one message, in bytes. Limited to
+        IoT Core's maximum telemetry payload size.
+    :param float max_latency: Maximum time a record is buffered for, in seconds.
+        Checked by poll(), which should be called from the application's loop.
+    :param bytes separator: Separator placed between records, defaults to a newline.
+
+    Example of batching sensor readings:
+    ..code-block:: python
+
+        batch = Batch_Publisher(google_mqtt, max_records=20, max_latency=30)
+        while True:
+            batch.add(sensor.temperature, subfolder="temperature")
+            batch.poll()
+            google_mqtt.loop()
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, mqtt_api, max_records=32, max_bytes=1024, max_latency=10,
+                 separator=b"\n"):
+        self._mqtt = mqtt_api
+        self.max_records = max_records
+        self.max_bytes = min(max_bytes, MAX_TELEMETRY_PAYLOAD)
+        self.max_latency = max_latency
+        self._separator = separator
+        # Buffers keyed by (topic, subfolder), as [payload, records, first record time]
+        self._batches = {}
+        # Flush statistics, of published batches only
+        self.flushes = 0
+        self.records_sent = 0
+        self.bytes_sent = 0
+        # Batches dropped by the rate limiter or scheduler
+        self.dropped = 0
+
+    def add(self, record, topic="events", subfolder=None):
+        """Adds a record to the batch for a topic and subfolder, publishing
+        the batch first if the record would not fit.
+
+        :param record: Data to publish, as a str, bytes, int or float.
+        :param str topic: MQTT topic. Defaults to events.
+        :param str subfolder: Optional MQTT topic subfolder. Defaults to None.
+        """
+        if isinstance(record, (int, float)):
+            record = str(record)
+        if isinstance(record, str):
+            record = record.encode("utf-8")
+        if len(record) > self.max_bytes:
+            raise ValueError("Record is larger than max_bytes.")
+        key = (topic, subfolder)
+        batch = self._batches.get(key, None)
+        if batch is None:
+            batch = [bytearray(), 0, 0]
+            self._batches[key] = batch
+        payload = batch[0]
+        if payload and len(payload) + len(self._separator) + len(record) > self.max_bytes:
+            self._flush_batch(key, batch)
+        if batch[1] == 0:
+            batch[2] = time.monotonic()
+        else:
+            payload.extend(self._separator)
+        payload.extend(record)
+        batch[1] += 1
+        if batch[1] >= self.max_records:
+            self._flush_batch(key, batch)
+
+    def poll(self):
+        """Publishes every batch whose oldest record is max_latency seconds old.
+        """
+        now = time.monotonic()
+        for key, batch in self._batches.items():
+            if batch[1] and now - batch[2] >= self.max_latency:
+                self._flush_batch(key, batch)
+
+    def flush(self):
+        """Publishes every buffered record.
+        """
+        for key, batch in self._batches.items():
+            if batch[1]:
+                self._flush_batch(key, batch)
+
+    @property
+    def pending(self):
+        """Returns the number of buffered, unpublished records.
+        """
+        return sum(batch[1] for batch in self._batches.values())
+
+    def _flush_batch(self, key, batch):
+        """Publishes a batch and empties its buffer.
+        """
+        payload = batch[0]
+        # Published without a copy, or copied if queued. The records are
+        # already encoded, so the codec isn't applied to the batch.
+        if self._mqtt.publish(payload, key[0], key[1], encode=False):
+            self.flushes += 1
+            self.records_sent += batch[1]
+            self.bytes_sent += len(payload)
+        else:
+            self.dropped += 1
+        # Keep the buffer's allocation for the next batch
+        payload[:] = b""
+        batch[1] = 0
+
+
+# pylint: disable=too-many-instance-attributes
+class Window_Aggregator:
+    """Summarizes readings over windows of time, publishing the minimum, maximum and
+    mean of each channel once per window to an events subfolder instead of every
+    reading. Windows are tumbling, or sliding if step is shorter than window, in
+    which case a window's statistics are kept for each step-long pane. Statistics
+    are kept in arrays allocated up front, so memory use is fixed.
+
+    :param MQTT_API mqtt_api: MQTT_API object to publish with.
+    :param str subfolder: Events subfolder the summaries are published to.
+    :param tuple channels: Names of the values in each reading.
+    :param float window: Length of a window, in seconds.
+    :param float step: Seconds between summaries of a sliding window, which must
+        divide window. Defaults to window, for tumbling windows.
+
+    Summaries are published as {"n": readings, channel: [min, max, mean], ...},
+    JSON encoded unless MQTT_API has a codec which encodes dicts, such as CBOR_Codec.
+
+    Example of summarizing 100Hz readings every minute:
+    ..code-block:: python
+
+        aggregator = Window_Aggregator(google_mqtt, "motion", ("x", "y", "z"), window=60)
+        while True:
+            aggregator.add(*accelerometer.acceleration)
+            google_mqtt.loop()
+            time.sleep(0.01)
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, mqtt_api, subfolder, channels=("value",), window=60, step=None):
+        self._mqtt = mqtt_api
+        self.subfolder = subfolder
+        self.channels = channels
+        self.window = window
+        self.step = step or window
+        panes = int(round(self.window / self.step))
+        if panes < 1 or abs(panes * self.step - self.window) > 0.001:
+            raise ValueError("step must divide window.")
+        # Statistics of each pane, channel by channel, single precision as on CircuitPython
+        size = panes * len(channels)
+        self._min = array.array("f", [0] * size)
+        self._max = array.array("f", [0] * size)
+        self._sum = array.array("f", [0] * size)
+        self._count = array.array("L", [0] * panes)
+        self._pane = 0
+        self._pane_end = time.monotonic() + self.step
+        self.readings = 0
+        self.summaries = 0
+
+    def add(self, *values):
+        """Adds a reading, one value for each channel, publishing a summary first
+        if a window has closed.
+        """
+        if len(values) != len(self.channels):
+            raise ValueError("A reading needs a value for each channel.")
+        self.poll()
+        pane = self._pane
+        index = pane * len(self.channels)
+        first = self._count[pane] == 0
+        for value in values:
+            if first or value < self._min[index]:
+                self._min[index] = value
+            if first or value > self._max[index]:
+                self._max[index] = value
+            self._sum[index] += value
+            index += 1
+        self._count[pane] += 1
+        self.readings += 1
+
+    def poll(self):
+        """Publishes a summary if a window has closed, returns True if it did.
+        Called by add, and should also be called from the application's loop
+        when readings may stop.
+        """
+        now = time.monotonic()
+        if now < self._pane_end:
+            return False
+        published = self._publish()
+        panes = len(self._count)
+        # Start the next pane, emptying any which ended without readings
+        for _ in range(panes):
+            self._pane = (self._pane + 1) % panes
+            self._clear(self._pane)
+            self._pane_end += self.step
+            if now < self._pane_end:
+                break
+            published = self._publish() or published
+        if now >= self._pane_end:
+            # Every pane is empty after a long gap
+            self._pane_end = now + self.step
+        return published
+
+    def _clear(self, pane):
+        """Empties a pane's statistics.
+        """
+        self._count[pane] = 0
+        start = pane * len(self.channels)
+        for index in range(start, start + len(self.channels)):
+            self._sum[index] = 0
+
+    def summary(self):
+        """Returns the summary of the current window, None if it has no readings.
+        """
+        count = sum(self._count)
+        if not count:
+            return None
+        summary = {"n": count}
+        channels = len(self.channels)
+        for channel, name in enumerate(self.channels):
+            low = high = None
+            total = 0
+            for pane, pane_count in enumerate(self._count):
+                if not pane_count:
+                    continue
+                index = pane * channels + channel
+                if low is None or self._min[index] < low:
+                    low = self._min[index]
+                if high is None or self._max[index] > high:
+                    high = self._max[index]
+                total += self._sum[index]
+            summary[name] = [low, high, total / count]
+        return summary
+
+    def flush(self):
+        """Publishes the summary of the current window and empties it, so that its
+        readings aren't published again. Returns True if it had readings.
+        """
+        published = self._publish()
+        for pane in range(len(self._count)):
+            self._clear(pane)
+        return published
+
+    def _publish(self):
+        """Publishes the summary of the current window, returns True if it had readings.
+        """
+        summary = self.summary()
+        if summary is None:
+            return False
+        self._mqtt.publish(_encode_dict(self._mqtt.codec, summary), "events", self.subfolder,
+                           encode=False)
+        self.summaries += 1
+        return True
@@ -0,0 +1,318 @@
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Modified by Brent Rubell for Adafruit Industries, 2019
+"""
+`adafruit_iotcore_time`
+================================================================================
+
+Time sources and clock synchronisation for Cloud_Core's JWTs. Imported by
+Cloud_Core, and usable on their own.
+
+* Author(s): Brent Rubell, Google Inc.
+
+Implementation Notes
+--------------------
+
+**Software and Dependencies:**
+
+* Adafruit CircuitPython firmware for the supported boards:
+  https://github.com/adafruit/circuitpython/releases
+
+"""
+import struct
+import time
+
+from adafruit_iotcore import _ticks_us
+
+__version__ = "0.0.0-auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_Cloud_IOT_Core.git"
+
+TIME_SERVICE = (
+    "https://io.adafruit.com/api/v2/%s/integrations/time/strftime?x-aio-key=%s"
+)
+
+# our strftime is %Y-%m-%d %H:%M:%S.%L %j %u %z %Z see http://strftime.net/ for decoding details
+# See https://apidock.com/ruby/DateTime/strftime for full options
+TIME_SERVICE_STRFTIME = (
+    "&fmt=%25Y-%25m-%25d+%25H%3A%25M%3A%25S.%25L+%25j+%25u+%25z+%25Z"
+)
+
+# Seconds between the NTP (1900) and Unix (1970) epochs
+NTP_TO_UNIX_EPOCH = 2208988800
+
+# Lower bound for Time_Sync's measured clock drift, in seconds per second
+MIN_CLOCK_DRIFT = 0.00001
+
+
+def _epoch_seconds(date_time):
+    """Returns seconds since the Unix epoch for a UTC date and time, without
+    depending on the board's time zone or time.mktime.
+
+    :param tuple date_time: Year, month, day, hours, minutes and seconds.
+    """
+    year, month, mday, hours, minutes, seconds = date_time
+    # Days from civil, see http://howardhinnant.github.io/date_algorithms.html
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + mday - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era * 146097 + day_of_era - 719468
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+class Strftime_Time_Source:
+    """Fetches the time from Adafruit IO's strftime time service. Each time it is
+    queried, the board's real-time clock is set to the local time at the location.
+
+    :param network_manager: Network Manager module, such as WiFiManager.
+    :param dict secrets: Secrets.py file, containing aio_username and aio_key.
+    :param logger: Optional logger object.
+    :param bool set_rtc: Sets the board's rtc module, if it has one, to the local
+        time when queried, defaults to True.
+    """
+
+    def __init__(self, network_manager, secrets, logger=None, set_rtc=True):
+        self._wifi = network_manager
+        self._secrets = secrets
+        self._logger = logger
+        self.set_rtc = set_rtc
+
+    # pylint: disable=line-too-long, too-many-locals
+    def fetch(self):
+        """Fetches the local time at the location from the time service.
+        Returns a tuple of the local time as a struct_time and the location's
+        UTC offset in seconds.
+        """
+        try:
+            aio_username = self._secrets["aio_username"]
+            aio_key = self._secrets["aio_key"]
+        except KeyError:
+            raise KeyError(
+                "\n\nOur time service requires a login/password to rate-limit. Please register for a free adafruit.io account and place the user/key in your secrets file under 'aio_username' and 'aio_key'"
+            )
+        location = self._secrets.get("timezone", None)
+        if location:
+            if self._logger:
+                self._logger.debug("Getting time for timezone.")
+            api_url = (TIME_SERVICE + "&tz=%s") % (aio_username, aio_key, location)
+        else:  # we'll try to figure it out from the IP address
+            if self._logger:
+                self._logger.debug("Getting time from IP Address..")
+            api_url = TIME_SERVICE % (aio_username, aio_key)
+        api_url += TIME_SERVICE_STRFTIME
+        response = self._wifi.get(api_url)
+        try:
+            times = response.text.split(" ")
+            the_date = times[0]
+            the_time = times[1]
+            year_day = int(times[2])
+            week_day = int(times[3])
+            utc_offset = times[4]
+            is_dst = None  # no way to know yet
+        except (KeyError, IndexError):
+            raise KeyError(
+                "Was unable to lookup the time, try setting secrets['timezone'] according to http://worldtimeapi.org/timezones"
+            )
+        finally:
+            # now clean up
+            response.close()
+            response = None
+        year, month, mday = [int(x) for x in the_date.split("-")]
+        the_time = the_time.split(".")[0]
+        hours, minutes, seconds = [int(x) for x in the_time.split(":")]
+        now = time.struct_time(
+            (year, month, mday, hours, minutes, seconds, week_day, year_day, is_dst)
+        )
+        # %z is formatted as +HHMM or -HHMM
+        offset = int(utc_offset[1:3]) * 3600 + int(utc_offset[3:5]) * 60
+        if utc_offset[0] == "-":
+            offset = -offset
+        return now, offset
+
+    def get_time(self):
+        """Returns the current UTC time in seconds since the Unix epoch.
+        """
+        now, offset = self.fetch()
+        if self.set_rtc:
+            try:
+                import rtc
+            except ImportError:
+                # Such as on CPython
+                pass
+            else:
+                rtc.RTC().datetime = now
+        return _epoch_seconds(now[:6]) - offset
+
+
+class SNTP_Time_Source:
+    """Fetches the time from an (S)NTP server over UDP.
+
+    :param socket_module: A socket module providing getaddrinfo and UDP sockets,
+        such as CPython's socket module.
+    :param str server: NTP server hostname, defaults to pool.ntp.org.
+    :param int port: NTP server port, defaults to 123.
+    :param float timeout: Socket timeout, in seconds.
+    """
+
+    def __init__(self, socket_module, server="pool.ntp.org", port=123, timeout=5):
+        self._socket = socket_module
+        self._server = server
+        self._port = port
+        self._timeout = timeout
+        self._packet = bytearray(48)
+
+    def get_time(self):
+        """Returns the current UTC time in seconds since the Unix epoch.
+        """
+        packet = self._packet
+        for i in range(48):
+            packet[i] = 0
+        # Leap indicator 0, version 3, client mode
+        packet[0] = 0x1B
+        address = self._socket.getaddrinfo(self._server, self._port)[0][-1]
+        sock = self._socket.socket(self._socket.AF_INET, self._socket.SOCK_DGRAM)
+        try:
+            sock.settimeout(self._timeout)
+            sock.sendto(packet, address)
+            size = sock.recv_into(packet)
+        finally:
+            sock.close()
+        # Stratum 0 is a "kiss-o'-death" reply without a usable time
+        if size < 48 or packet[1] == 0:
+            raise RuntimeError("Invalid response from NTP server.")
+        # Transmit timestamp, in seconds since 1900
+        seconds = struct.unpack_from("!I", packet, 40)[0]
+        return seconds - NTP_TO_UNIX_EPOCH
+
+
+class HTTP_Date_Time_Source:
+    """Reads the time from the Date header of an HTTP response.
+
+    :param network_manager: Network Manager module, such as WiFiManager.
+    :param str url: URL to request, defaults to Google's MQTT bridge.
+    """
+
+    MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+              "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+    def __init__(self, network_manager, url="https://mqtt.googleapis.com"):
+        self._wifi = network_manager
+        self._url = url
+
+    @staticmethod
+    def parse(date):
+        """Returns seconds since the Unix epoch for an HTTP Date header,
+        such as "Sun, 06 Nov 1994 08:49:37 GMT".
+        """
+        fields = date.split(" ")
+        hours, minutes, seconds = [int(x) for x in fields[4].split(":")]
+        return _epoch_seconds((
+            int(fields[3]),
+            HTTP_Date_Time_Source.MONTHS.index(fields[2]) + 1,
+            int(fields[1]),
+            hours,
+            minutes,
+            seconds,
+        ))
+
+    @staticmethod
+    def response_time(response):
+        """Returns seconds since the Unix epoch for the Date header of
+        response, or None if it does not have one.
+        """
+        headers = response.headers
+        date = headers.get("date", None) or headers.get("Date", None)
+        if date is None:
+            return None
+        return HTTP_Date_Time_Source.parse(date)
+
+    def get_time(self):
+        """Returns the current UTC time in seconds since the Unix epoch.
+        """
+        response = self._wifi.get(self._url)
+        try:
+            now = self.response_time(response)
+        finally:
+            response.close()
+        if now is None:
+            raise RuntimeError("Response from {} has no Date header.".format(self._url))
+        return now
+
+
+class Time_Sync:
+    """Keeps the current time as an offset from the monotonic clock, so the
+    time source is only queried again once the estimated clock drift could
+    exceed max_error.
+
+    :param time_source: Object with a get_time() method returning seconds since the
+        Unix epoch, such as Strftime_Time_Source, SNTP_Time_Source or HTTP_Date_Time_Source.
+    :param int max_error: Largest error, in seconds, tolerated before re-syncing.
+    :param float drift: Initial estimate of the monotonic clock's drift, in seconds per
+        second. Defaults to 100ppm until it has been measured by a second sync.
+    """
+
+    def __init__(self, time_source, max_error=5, drift=0.0001):
+        self.source = time_source
+        self.max_error = max_error
+        self.drift = drift
+        self.syncs = 0
+        # Optional Metrics recording the latency of each sync
+        self.metrics = None
+        # Offsets are kept as integers, a float epoch loses precision on CircuitPython
+        self._offset = None
+        self._synced = 0
+
+    def set_time(self, now):
+        """Sets the current time, such as one read from another HTTP response's
+        Date header, and updates the drift estimate.
+
+        :param int now: Current UTC time, in seconds since the Unix epoch.
+        """
+        monotonic = int(time.monotonic())
+        elapsed = monotonic - self._synced
+        if self._offset is not None and elapsed > 0:
+            # Less one second for the resolution of both readings
+            error = max(abs(self._offset + monotonic - now) - 1, 0)
+            self.drift = max((self.drift + error / elapsed) / 2, MIN_CLOCK_DRIFT)
+        self._offset = int(now) - monotonic
+        self._synced = monotonic
+        self.syncs += 1
+
+    def sync(self):
+        """Queries the time source and updates the clock offset.
+        """
+        start = _ticks_us()
+        now = self.source.get_time()
+        if self.metrics is not None:
+            self.metrics.sync_latency.record(_ticks_us() - start)
+        self.set_time(now)
+
+    @property
+    def needs_sync(self):
+        """Returns True if the clock has not been synced, or if it may have
+        drifted by more than max_error seconds since it was.
+        """
+        if self._offset is None:
+            return True
+        return (int(time.monotonic()) - self._synced) * self.drift > self.max_error
+
+    def time(self):
+        """Returns the current UTC time in seconds since the Unix epoch,
+        syncing with the time source first if needed.
+        """
+        if self.needs_sync:
+            self.sync()
+        return self._offset + int(time.monotonic())
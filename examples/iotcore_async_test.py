@@ -0,0 +1,89 @@
+import asyncio
+
+from iotcore_broker_stand_in import Broker_Stand_In
+from adafruit_iotcore import MQTT_API_ERROR
+from adafruit_iotcore_async import AsyncMQTT_API
+
+# Checks AsyncMQTT_API against a local asyncio stand-in for IoT Core's MQTT
+# bridge: CONNECT, SUBSCRIBE, QoS 0 and QoS 1 publishes, and iterating over
+# inbound commands. Runs on CPython, and raises AssertionError on the first
+# failed check.
+#
+#     python3 iotcore_async_test.py
+
+CLIENT_ID = "projects/test/locations/us-central1/registries/test/devices/test"
+
+# A well-formed, unsigned JWT, not checked by the stand-in
+TEST_JWT = (
+    "eyJ0eXAiOiAiSldUIiwgImFsZyI6ICJSUzI1NiJ9.eyJhdWQiOiAiYmVuY2htYXJrIn0=.c2ln"
+)
+
+# Commands the stand-in sends once the client subscribes, as (topic, payload, qos)
+COMMANDS = (
+    ("/devices/test/commands/reboot", b"now", 1),
+    ("/devices/test/commands/led", b"on", 0),
+)
+
+async def test_session(port, broker):
+    async def transport(host, port):
+        return await asyncio.open_connection(host, port)
+    google_mqtt = AsyncMQTT_API(CLIENT_ID, TEST_JWT, "127.0.0.1", port, transport)
+
+    await google_mqtt.connect()
+    assert google_mqtt.is_connected
+    assert broker.connects == [(CLIENT_ID, TEST_JWT)], broker.connects
+
+    granted = await google_mqtt.subscribe_to_all_commands()
+    assert granted == 1, granted
+    assert broker.subscriptions == [("/devices/test/commands/#", 1)], broker.subscriptions
+
+    await google_mqtt.publish("zero")
+    ack = await google_mqtt.publish(1, "events", "counts", qos=1)
+    assert ack.done() and google_mqtt.inflight == 0
+    assert broker.published == [("/devices/test/events", b"zero", 0),
+                                ("/devices/test/events/counts", b"1", 1)], broker.published
+
+    messages = []
+    async for topic, payload in google_mqtt:
+        messages.append((topic, payload))
+        if len(messages) == len(COMMANDS):
+            break
+    assert messages == [command[:2] for command in COMMANDS], messages
+
+    await google_mqtt.disconnect()
+    await broker.disconnected.wait()
+    assert not google_mqtt.is_connected
+    # Only the QoS 1 command is acknowledged
+    assert broker.acknowledged == [7], broker.acknowledged
+    return google_mqtt
+
+async def test_disconnected(google_mqtt):
+    for qos in (0, 1):
+        try:
+            await google_mqtt.publish("late", qos=qos)
+        except MQTT_API_ERROR:
+            pass
+        else:
+            raise AssertionError("publish with qos={} after disconnect".format(qos))
+
+async def test_qos2(google_mqtt):
+    try:
+        await google_mqtt.subscribe("config", qos=2)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("subscribe with qos=2")
+
+async def main():
+    broker = Broker_Stand_In()
+    broker.commands = COMMANDS
+    await broker.start()
+    google_mqtt = await test_session(broker.port, broker)
+    print("test_session passed")
+    await test_disconnected(google_mqtt)
+    print("test_disconnected passed")
+    await test_qos2(google_mqtt)
+    print("test_qos2 passed")
+    await broker.stop()
+
+asyncio.run(main()) # pylint: disable=no-member
@@ -0,0 +1,290 @@
+import gc
+import json
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import argparse
+except ImportError:
+    argparse = None
+
+try:
+    import types
+except ImportError:
+    # CircuitPython, where the libraries stood in for below are installed
+    types = None
+
+try:
+    import rtc # pylint: disable=unused-import
+except ImportError:
+    # Running on CPython, which has no rtc module for Strftime_Time_Source to set
+    sys.modules["rtc"] = types.SimpleNamespace(RTC=lambda: types.SimpleNamespace(datetime=None))
+
+# Stand-ins for the CircuitPython libraries, used if they aren't installed
+try:
+    import adafruit_logging # pylint: disable=unused-import
+except ImportError:
+    import logging as adafruit_logging
+    sys.modules["adafruit_logging"] = adafruit_logging
+
+try:
+    import adafruit_jwt # pylint: disable=unused-import
+except ImportError:
+    import binascii
+
+    class Stub_String_Tools:
+        """urlsafe base64 helpers with adafruit_jwt's interface."""
+
+        @staticmethod
+        def urlsafe_b64encode(payload):
+            text = binascii.b2a_base64(payload).decode("utf-8").rstrip("\n")
+            return text.replace("+", "-").replace("/", "_")
+
+        @staticmethod
+        def urlsafe_b64decode(payload):
+            text = payload.replace("-", "+").replace("_", "/")
+            return binascii.a2b_base64(text).decode("utf-8")
+
+    class Stub_JWT:
+        """JWT.validate checking only the shape of a token."""
+
+        @staticmethod
+        def validate(jwt):
+            header, claims, _ = jwt.split(".")
+            return (json.loads(Stub_String_Tools.urlsafe_b64decode(header)),
+                    json.loads(Stub_String_Tools.urlsafe_b64decode(claims)))
+
+    adafruit_jwt = types.ModuleType("adafruit_jwt")
+    adafruit_jwt.JWT = Stub_JWT
+    adafruit_jwt.STRING_TOOLS = Stub_String_Tools
+    sys.modules["adafruit_jwt"] = adafruit_jwt
+
+try:
+    import adafruit_rsa # pylint: disable=unused-import
+except ImportError:
+    # Only ES256 JWTs are benchmarked, RSA signing is never called
+    adafruit_rsa = types.ModuleType("adafruit_rsa")
+    adafruit_rsa.PrivateKey = None
+    adafruit_rsa.sign = None
+    sys.modules["adafruit_rsa"] = adafruit_rsa
+
+from iotcore_mqtt_stand_in import Null_MQTT
+from adafruit_iotcore import MQTT_API, Cloud_Core
+from adafruit_iotcore_codec import CBOR_Codec, Struct_Codec, Buffer_Pool
+from adafruit_iotcore_queue import Outbox
+from adafruit_iotcore_routing import Duplicate_Filter
+from adafruit_iotcore_telemetry import Window_Aggregator
+
+# Microbenchmarks for adafruit_iotcore's per-message paths. These use an
+# in-memory stand-in for MiniMQTT, so they need no network connection and
+# run on CircuitPython as well as CPython.
+#
+# On CPython, results can be saved as JSON and compared against a saved
+# baseline, exiting with status 1 if any benchmark has regressed:
+#
+#     python3 iotcore_benchmark.py --output baseline.json
+#     python3 iotcore_benchmark.py --baseline baseline.json
+
+# Number of operations timed for each benchmark
+ROUNDS = 2000
+
+# Number of messages replayed from an Outbox file, fewer on microcontrollers
+if sys.implementation.name == "cpython":
+    OUTBOX_MESSAGES = 100000
+else:
+    OUTBOX_MESSAGES = 500
+OUTBOX_PATH = "iotcore_benchmark_outbox.bin"
+
+# Adafruit IO time service response parsed by Strftime_Time_Source
+TIME_SERVICE_RESPONSE = "2019-07-30 14:32:05.123 211 2 -0400 EDT"
+
+# Results of every benchmark, keyed by name
+RESULTS = {}
+
+class Time_Response:
+    """Response from the time service stand-in."""
+
+    text = TIME_SERVICE_RESPONSE
+
+    def close(self):
+        pass
+
+class ESPSPI_WiFiManager:
+    """Network manager stand-in, answering every request with TIME_SERVICE_RESPONSE."""
+
+    # pylint: disable=unused-argument, no-self-use
+    def get(self, url, **kwargs):
+        return Time_Response()
+
+def heap_per_call(func, rounds):
+    """Returns the mean heap bytes allocated by a call of func, including those
+    of the measurement itself."""
+    func()
+    if tracemalloc is not None:
+        # The most heap in use during each call, above what was in use before it
+        total = 0
+        tracemalloc.start()
+        for _ in range(rounds):
+            tracemalloc.reset_peak() # pylint: disable=no-member
+            before = tracemalloc.get_traced_memory()[0]
+            func()
+            total += tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        return total / rounds
+    # MicroPython and CircuitPython, counting every allocation with the collector paused
+    gc.collect()
+    gc.disable()
+    start = gc.mem_alloc() # pylint: disable=no-member
+    for _ in range(rounds):
+        func()
+    used = gc.mem_alloc() - start # pylint: disable=no-member
+    gc.enable()
+    return used / rounds
+
+def heap_per_op(func, rounds):
+    """Returns the heap bytes allocated by one call of func, less those
+    allocated by the measurement loop around an empty call."""
+    return max(heap_per_call(func, rounds) - heap_per_call(lambda: None, rounds), 0)
+
+def benchmark(name, func, rounds=ROUNDS):
+    """Prints and records the time and heap used by one call of func."""
+    func()
+    start = time.monotonic()
+    for _ in range(rounds):
+        func()
+    elapsed = time.monotonic() - start
+    result = {"us_per_op": elapsed * 1000000 / rounds, "bytes_per_op": heap_per_op(func, rounds)}
+    RESULTS[name] = result
+    print("{:<32}{:>10.2f} us/op{:>10.0f} bytes/op".format(
+        name, result["us_per_op"], result["bytes_per_op"]))
+
+def compare(baseline, tolerance):
+    """Prints each result against the baseline, returning the names of the
+    benchmarks which are more than tolerance (a fraction) worse than it.
+    Rates, ending in _per_s, are better when higher, all other results when lower.
+    """
+    regressions = []
+    for name, result in RESULTS.items():
+        for metric, value in result.items():
+            old = baseline.get(name, {}).get(metric)
+            if not old:
+                continue
+            change = (value - old) / old
+            if metric.endswith("_per_s"):
+                change = -change
+            regressed = change > tolerance
+            print("{:<32}{:<14}{:>+9.1f}%{}".format(
+                name, metric, change * 100, "  REGRESSED" if regressed else ""))
+            if regressed and name not in regressions:
+                regressions.append(name)
+    return regressions
+
+def benchmark_publish():
+    """Topic building, binary frames and windowed aggregation."""
+    google_mqtt = MQTT_API(Null_MQTT("bench", record=False))
+    google_mqtt.topic_cache_size = 0
+    benchmark("publish (uncached topic)", lambda: google_mqtt.publish(1, "events", "sensors"))
+    google_mqtt.topic_cache_size = 16
+    benchmark("publish (cached topic)", lambda: google_mqtt.publish(1, "events", "sensors"))
+    benchmark("subscribe", lambda: google_mqtt.subscribe("commands", "reset"))
+
+    # Binary frames, published from a reused buffer
+    google_mqtt.connect()
+    frame = Buffer_Pool(1, 12).acquire()
+    benchmark("publish (bytes frame)", lambda: google_mqtt.publish(bytes(frame)))
+    benchmark("publish (buffer frame)", lambda: google_mqtt.publish(frame))
+
+    # Readings summarized by a sliding window, instead of published
+    aggregator = Window_Aggregator(google_mqtt, "motion", ("x", "y", "z"), window=60, step=10)
+    benchmark("aggregate (3 channels)", lambda: aggregator.add(0.5, -0.25, 9.75))
+
+def benchmark_dispatch():
+    """Inbound message dispatch through the command router."""
+    # pylint: disable=protected-access
+    def command_handler(_client, _topic, _payload):
+        pass
+
+    def dispatch(mqtt, topic):
+        return lambda: mqtt._on_message_mqtt(None, topic, b"1")
+
+    for routes in (1, 50, 500):
+        router_mqtt = MQTT_API(Null_MQTT("bench", record=False))
+        for i in range(routes):
+            router_mqtt.add_route("commands/command%d" % i, command_handler)
+        topic = "/devices/bench/commands/command%d" % (routes - 1)
+        benchmark("dispatch ({} routes)".format(routes), dispatch(router_mqtt, topic))
+
+    # Redelivered commands, suppressed before they are dispatched
+    router_mqtt.duplicate_filter = Duplicate_Filter()
+    benchmark("dispatch (duplicate)", dispatch(router_mqtt, topic))
+
+def benchmark_jwt():
+    """JWT claims, encoding and caching, signed by a stand-in signer so that
+    only the library's own work is timed, and parsing the time service's response."""
+    secrets = {"project_id": "bench", "cloud_region": "us-central1", "registry_id": "bench",
+               "device_id": "bench", "aio_username": "bench", "aio_key": "bench"}
+    cloud_core = Cloud_Core(ESPSPI_WiFiManager(), secrets, ecdsa_signer=lambda _: bytes(64))
+    benchmark("generate_jwt (ES256)", lambda: cloud_core.generate_jwt(algo="ES256"))
+    benchmark("jwt (cached)", lambda: cloud_core.jwt)
+    benchmark("Strftime_Time_Source", cloud_core.time_sync.source.get_time)
+
+def benchmark_encodings():
+    """Payload encodings of one sensor reading."""
+    reading = {"temperature": 21.5, "humidity": 40.25, "pressure": 1013, "battery": 87}
+    packed = Struct_Codec()
+    packed.register(1, "<ffHB")
+    for name, encode, value in (("json", json.dumps, reading),
+                                ("cbor", CBOR_Codec().encode, reading),
+                                ("struct", packed.encode, (1, (21.5, 40.25, 1013, 87)))):
+        size = len(encode(value))
+        RESULTS[name + " payload"] = {"bytes": size}
+        print("{:<32}{:>10} bytes".format(name + " payload", size))
+        benchmark(name + " encode", lambda encode=encode, value=value: encode(value))
+
+def benchmark_outbox():
+    """Replaying queued messages from an Outbox file."""
+    outbox = Outbox(size=1, path=OUTBOX_PATH, max_file_size=OUTBOX_MESSAGES * 64)
+    for i in range(OUTBOX_MESSAGES):
+        outbox.put("/devices/bench/events", "reading %d" % i)
+    client = Null_MQTT("bench", record=False)
+    start = time.monotonic()
+    while outbox:
+        outbox.drain(client.publish, 1000)
+    rate = client.messages / (time.monotonic() - start)
+    RESULTS["outbox replay"] = {"messages_per_s": rate}
+    print("{:<32}{:>10.0f} messages/s".format("outbox replay", rate))
+
+def main():
+    output = baseline = None
+    tolerance = 0.25
+    if argparse is not None:
+        parser = argparse.ArgumentParser(description="adafruit_iotcore microbenchmarks")
+        parser.add_argument("--output", help="Write results to this JSON file")
+        parser.add_argument("--baseline", help="Compare results with this JSON file")
+        parser.add_argument("--tolerance", type=float, default=tolerance,
+                            help="Fraction by which a result may be worse than the baseline")
+        args = parser.parse_args()
+        output, baseline, tolerance = args.output, args.baseline, args.tolerance
+
+    benchmark_publish()
+    benchmark_dispatch()
+    benchmark_jwt()
+    benchmark_encodings()
+    benchmark_outbox()
+
+    if output is not None:
+        with open(output, "w") as results_file:
+            json.dump(RESULTS, results_file, indent=2, sort_keys=True)
+    if baseline is not None:
+        with open(baseline) as baseline_file:
+            regressions = compare(json.load(baseline_file), tolerance)
+        if regressions:
+            print("Regressed: " + ", ".join(regressions))
+            sys.exit(1)
+
+main()
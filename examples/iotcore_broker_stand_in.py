@@ -0,0 +1,155 @@
+import asyncio
+import struct
+
+from adafruit_iotcore_packet import _mqtt_packet, _mqtt_string
+
+# Local asyncio stand-in for IoT Core's MQTT bridge, shared by the examples
+# which test or load AsyncMQTT_API and MQTT_API without a network connection.
+# Runs on CPython.
+
+async def read_packet(reader):
+    """Reads an MQTT packet, returning its type and body."""
+    header = await reader.readexactly(1)
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    return header[0], await reader.readexactly(length)
+
+def read_string(body, offset):
+    """Reads a length-prefixed MQTT string, returning it and the offset after it."""
+    length = struct.unpack_from(">H", body, offset)[0]
+    offset += 2
+    return body[offset:offset + length].decode("utf-8"), offset + length
+
+class Broker_Stand_In:
+    """Accepts every client, grants every subscription and acknowledges QoS 1
+    messages after ack_delay seconds, recording what clients send. Subclasses
+    override connect, publish, subscribe and timeout to check clients as IoT
+    Core does.
+
+    :param float ack_delay: Seconds before each PUBACK, such as a simulated round trip.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, ack_delay=0):
+        self.ack_delay = ack_delay
+        # Commands sent to each client once it subscribes, as (topic, payload, qos)
+        self.commands = ()
+        self.port = None
+        self.connects = []
+        self.subscriptions = []
+        self.published = []
+        self.acknowledged = []
+        # Sessions closed by timeout
+        self.timeouts = 0
+        self.disconnected = None
+        self._server = None
+        # Session tasks, keyed by their connection's writer
+        self._sessions = {}
+
+    async def start(self):
+        """Listens on a free local port, setting port."""
+        self.disconnected = asyncio.Event()
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stops listening and closes every session."""
+        self._server.close()
+        for writer in list(self._sessions):
+            writer.close()
+        await asyncio.gather(*self._sessions.values(), return_exceptions=True)
+        await self._server.wait_closed()
+
+    def connect(self, client_id, password):
+        """Returns the CONNACK return code for a client, 0 to accept it."""
+        self.connects.append((client_id, password))
+        return 0
+
+    # pylint: disable=unused-argument
+    def publish(self, client_id, topic, payload, qos):
+        """Records a message, returns False to disconnect the client instead."""
+        self.published.append((topic, payload, qos))
+        return True
+
+    def subscribe(self, client_id, topic, qos):
+        """Records a subscription, returning the granted QoS or 0x80 to refuse it."""
+        self.subscriptions.append((topic, qos))
+        return qos
+
+    def timeout(self, client_id): # pylint: disable=no-self-use
+        """Returns the seconds until a client's session is closed, None for no limit."""
+        return None
+
+    async def _handle(self, reader, writer):
+        self._sessions[writer] = asyncio.current_task() # pylint: disable=no-member
+        try:
+            packet_type, body = await read_packet(reader)
+            if packet_type != 0x10:
+                return
+            # Skip the protocol name and level, keep the flags
+            flags = body[7]
+            client_id, offset = read_string(body, 10)
+            password = None
+            if flags & 0x80:
+                _, offset = read_string(body, offset)
+            if flags & 0x40:
+                password, offset = read_string(body, offset)
+            return_code = self.connect(client_id, password)
+            writer.write(bytes((0x20, 2, 0, return_code)))
+            if not return_code:
+                await self._session(reader, writer, client_id)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self._sessions[writer]
+            writer.close()
+            self.disconnected.set()
+
+    async def _session(self, reader, writer, client_id):
+        while True:
+            try:
+                packet_type, body = await asyncio.wait_for(read_packet(reader),
+                                                           self.timeout(client_id))
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                return
+            if packet_type & 0xF0 == 0x30:
+                topic, offset = read_string(body, 0)
+                qos = (packet_type >> 1) & 0x03
+                packet_id = body[offset:offset + 2] if qos else None
+                if qos:
+                    offset += 2
+                if not self.publish(client_id, topic, body[offset:], qos):
+                    return
+                if packet_id is not None:
+                    self._acknowledge(writer, packet_id)
+            elif packet_type == 0x82:
+                topic, offset = read_string(body, 2)
+                granted = self.subscribe(client_id, topic, body[offset])
+                writer.write(_mqtt_packet(0x90, body[:2] + bytes((granted,))))
+                self._send_commands(writer)
+            elif packet_type == 0x40:
+                self.acknowledged.append(struct.unpack_from(">H", body)[0])
+            elif packet_type == 0xC0:
+                writer.write(b"\xd0\x00")
+            elif packet_type == 0xE0:
+                return
+            await writer.drain()
+
+    def _acknowledge(self, writer, packet_id):
+        puback = _mqtt_packet(0x40, packet_id)
+        if self.ack_delay:
+            asyncio.get_event_loop().call_later(self.ack_delay, writer.write, puback)
+        else:
+            writer.write(puback)
+
+    def _send_commands(self, writer):
+        for packet_id, (topic, payload, qos) in enumerate(self.commands, 7):
+            packet_id = struct.pack(">H", packet_id) if qos else b""
+            writer.write(_mqtt_packet(0x30 | qos << 1, _mqtt_string(topic) + packet_id + payload))
@@ -0,0 +1,69 @@
+import gc
+import time
+import board
+import busio
+from digitalio import DigitalInOut
+import neopixel
+import adafruit_hashlib as hashlib
+from adafruit_atecc.adafruit_atecc import ATECC, _WAKE_CLK_FREQ
+from adafruit_esp32spi import adafruit_esp32spi
+from adafruit_esp32spi import adafruit_esp32spi_wifimanager
+
+from adafruit_iotcore import Cloud_Core
+
+# Compares the time and heap used to issue RS256 and ES256 JSON Web Tokens.
+# ES256 tokens are signed by an ATECC608 crypto co-processor whose slot 0
+# holds the device's P-256 private key, with the matching public key
+# registered with the IoT Core device.
+
+# Number of tokens to issue for each algorithm
+ROUNDS = 5
+
+# WiFi details, and the device's Cloud IoT Core settings, are kept in secrets.py
+try:
+    from secrets import secrets
+except ImportError:
+    print("Add your WiFi and Cloud IoT Core settings to secrets.py!")
+    raise
+
+# A board with pre-defined ESP32 pins
+esp = adafruit_esp32spi.ESP_SPIcontrol(
+    busio.SPI(board.SCK, board.MOSI, board.MISO),
+    DigitalInOut(board.ESP_CS), DigitalInOut(board.ESP_BUSY), DigitalInOut(board.ESP_RESET))
+status_light = neopixel.NeoPixel(board.NEOPIXEL, 1, brightness=0.2)
+wifi = adafruit_esp32spi_wifimanager.ESPSPI_WiFiManager(esp, secrets, status_light)
+
+# Initialize the ATECC608 on the board's I2C bus
+i2c = busio.I2C(board.SCL, board.SDA, frequency=_WAKE_CLK_FREQ)
+atecc = ATECC(i2c)
+
+def atecc_signer(message):
+    # The ATECC608 signs a SHA-256 digest of the JWT signing input
+    digest = hashlib.sha256(message).digest()
+    return atecc.ecdsa_sign(0, digest)
+
+print("connecting to WiFi...")
+wifi.connect()
+print("Connected!")
+
+rsa_core = Cloud_Core(wifi, secrets)
+ec_core = Cloud_Core(wifi, secrets, ecdsa_signer=atecc_signer)
+
+def benchmark(cloud_core):
+    # Tokens are signed with the core's jwt_algo, ES256 if it has an ecdsa_signer
+    # The first token also parses the key and encodes the JWT header
+    cloud_core.generate_jwt()
+    elapsed = 0
+    heap_used = 0
+    for _ in range(ROUNDS):
+        gc.collect()
+        free = gc.mem_free() # pylint: disable=no-member
+        start = time.monotonic()
+        cloud_core.generate_jwt()
+        elapsed += time.monotonic() - start
+        heap_used = max(heap_used, free - gc.mem_free()) # pylint: disable=no-member
+    print("{}: {:.3f}s per token, {} bytes of heap".format(
+        cloud_core.jwt_algo, elapsed / ROUNDS, heap_used))
+
+benchmark(rsa_core)
+benchmark(ec_core)
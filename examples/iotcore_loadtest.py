@@ -0,0 +1,292 @@
+import argparse
+import asyncio
+import json
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import types
+
+try:
+    import rtc # pylint: disable=unused-import
+except ImportError:
+    # Running on CPython, which has no rtc module
+    rtc = types.ModuleType("rtc")
+    rtc.RTC = type("RTC", (), {"datetime": None})
+    sys.modules["rtc"] = rtc
+
+from iotcore_broker_stand_in import Broker_Stand_In
+from adafruit_jwt import STRING_TOOLS
+from adafruit_iotcore import Cloud_Core, MQTT_API, MQTT_API_ERROR
+from adafruit_iotcore_packet import _mqtt_packet, _mqtt_string
+from adafruit_iotcore_queue import Token_Bucket
+
+# Load test for adafruit_iotcore on Linux. Runs a local stand-in for IoT Core's
+# MQTT bridge and many simulated devices, each with its own Cloud_Core and
+# MQTT_API, then reports throughput, publish-to-broker latency and reconnects.
+#
+# The stand-in emulates IoT Core's topic layout, disconnects clients whose JWT
+# has expired and disconnects devices which exceed their publish quota.
+#
+#     python3 iotcore_loadtest.py --clients 50 --rate 10 --duration 30 --jwt-ttl 20
+
+def percentile(values, fraction):
+    """Returns the value at a fraction of the sorted values."""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def jwt_expiry(jwt):
+    """Returns the exp claim of a JWT, or None if it can't be read."""
+    try:
+        return json.loads(STRING_TOOLS.urlsafe_b64decode(jwt.split(".")[1]))["exp"]
+    except (ValueError, KeyError, IndexError):
+        return None
+
+class IoT_Core_Stand_In(Broker_Stand_In):
+    """Broker stand-in with IoT Core's topic layout, JWT expiry and publish quotas,
+    run on its own thread."""
+
+    def __init__(self, events_quota, state_quota):
+        super().__init__()
+        self.events_quota = events_quota
+        self.state_quota = state_quota
+        self.received = 0
+        self.latencies = []
+        self.rejected = 0
+        self.disconnects = {"quota": 0, "topic": 0}
+        # Each connected device's JWT expiry and publish quotas, keyed by client id
+        self._devices = {}
+        self._loop = asyncio.new_event_loop()
+
+    def run(self):
+        """Starts the broker on a new thread, returning once it is listening."""
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.start(), self._loop).result()
+
+    def shutdown(self):
+        """Closes every session and stops the broker's thread."""
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def connect(self, client_id, password):
+        expiry = jwt_expiry(password or "")
+        if expiry is None or expiry <= time.time():
+            # Connection refused, not authorized
+            self.rejected += 1
+            return 5
+        self.connects.append((client_id, None))
+        self._devices[client_id] = (expiry, {
+            "events": Token_Bucket(self.events_quota, self.events_quota),
+            "state": Token_Bucket(self.state_quota, self.state_quota)})
+        return 0
+
+    def publish(self, client_id, topic, payload, qos):
+        prefix = "/devices/{}/".format(client_id.split("/")[7])
+        buckets = self._devices[client_id][1]
+        if topic == prefix + "state":
+            bucket = buckets["state"]
+        elif topic.startswith(prefix + "events"):
+            bucket = buckets["events"]
+        else:
+            self.disconnects["topic"] += 1
+            return False
+        if not bucket.take():
+            self.disconnects["quota"] += 1
+            return False
+        self.received += 1
+        try:
+            self.latencies.append(time.monotonic() - float(payload))
+        except ValueError:
+            pass
+        return True
+
+    def subscribe(self, client_id, topic, qos):
+        prefix = "/devices/{}/".format(client_id.split("/")[7])
+        return 1 if topic in (prefix + "config", prefix + "commands/#") else 0x80
+
+    def timeout(self, client_id):
+        return max(self._devices[client_id][0] - time.time(), 0)
+
+class ESPSPI_WiFiManager:
+    """Network manager stand-in, serving Adafruit IO's time service from the local clock."""
+
+    # pylint: disable=unused-argument, no-self-use
+    def get(self, url, **kwargs):
+        now = time.gmtime()
+        text = time.strftime("%Y-%m-%d %H:%M:%S.000 %j %u +0000 UTC", now)
+        return types.SimpleNamespace(text=text, headers={}, close=lambda: None)
+
+class Sim_MQTT:
+    """Blocking-socket MQTT client with MiniMQTT's interface."""
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, port, client_id):
+        self._port = port
+        self._user = "unused"
+        self._pass = None
+        self._keep_alive = 60
+        self._logger = None
+        self._client_id = client_id
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self._sock = None
+        # Named as in MiniMQTT, as MQTT_API shares its packet ids
+        self._pid = 0
+
+    # pylint: disable=not-callable
+    def connect(self):
+        self._sock = socket.create_connection(("127.0.0.1", self._port), timeout=5)
+        body = (_mqtt_string("MQTT") + struct.pack(">BBH", 4, 0xC2, self._keep_alive)
+                + _mqtt_string(self._client_id) + _mqtt_string(self._user)
+                + _mqtt_string(self._pass))
+        self._sock.sendall(_mqtt_packet(0x10, body))
+        return_code = self._sock.recv(4)[3]
+        if return_code:
+            self._sock.close()
+            self._sock = None
+        if self.on_connect is not None:
+            self.on_connect(self, None, 0, return_code)
+
+    def _lost(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if self.on_disconnect is not None:
+                self.on_disconnect(self, None, 0)
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        if self._sock is None:
+            raise OSError("Not connected.")
+        if isinstance(msg, (int, float)):
+            msg = str(msg)
+        if not isinstance(msg, str):
+            # As MiniMQTT, MQTT_API writes binary payloads to the socket itself
+            raise TypeError("Invalid message data type.")
+        msg = msg.encode("utf-8")
+        body = _mqtt_string(topic)
+        if qos:
+            self._pid = self._pid % 65535 + 1
+            body += struct.pack(">H", self._pid)
+        try:
+            self._sock.sendall(_mqtt_packet(0x30 | qos << 1 | retain, body + msg))
+        except OSError:
+            self._lost()
+            raise
+
+    def subscribe(self, topic, qos=0):
+        self._pid = self._pid % 65535 + 1
+        body = struct.pack(">H", self._pid) + _mqtt_string(topic) + bytes((qos,))
+        self._sock.sendall(_mqtt_packet(0x82, body))
+
+    def loop(self):
+        # Acknowledgements are discarded, a closed connection is reported
+        while self._sock is not None and select.select([self._sock], [], [], 0)[0]:
+            try:
+                data = self._sock.recv(4096)
+            except OSError:
+                data = b""
+            if not data:
+                self._lost()
+
+    def disconnect(self):
+        if self._sock is not None:
+            self._sock.sendall(b"\xe0\x00")
+            self._sock.close()
+            self._sock = None
+
+    def deinit(self):
+        pass
+
+class Load_Stats:
+    """Publish and reconnect counts from every simulated device."""
+
+    def __init__(self):
+        self.published = 0
+        self.failed_connects = 0
+        self.reconnects = []
+
+    def reconnected(self):
+        """Records a device reconnecting."""
+        self.reconnects.append(time.monotonic())
+
+    def peak_reconnects(self):
+        """Returns the most reconnects within one second, to find reconnect storms."""
+        storm = {}
+        for reconnect in self.reconnects:
+            storm[int(reconnect)] = storm.get(int(reconnect), 0) + 1
+        return max(storm.values()) if storm else 0
+
+def run_device(index, port, args, stats, end):
+    secrets = {"project_id": "loadtest", "cloud_region": "us-central1",
+               "registry_id": "loadtest", "device_id": "device-%d" % index,
+               "aio_username": "loadtest", "aio_key": "loadtest"}
+    # Tokens are not verified by the stand-in, skip the cost of signing them
+    cloud_core = Cloud_Core(ESPSPI_WiFiManager(), secrets, ecdsa_signer=lambda _: bytes(64))
+    cloud_core.jwt_ttl = args.jwt_ttl
+    cloud_core.jwt_refresh_margin = args.jwt_ttl // 4
+    google_mqtt = MQTT_API(Sim_MQTT(port, cloud_core.cid), cloud_core)
+    interval = 1 / args.rate
+    first_connect = True
+    next_publish = time.monotonic()
+    while time.monotonic() < end:
+        if not google_mqtt.is_connected:
+            try:
+                google_mqtt.connect()
+            except (OSError, MQTT_API_ERROR):
+                stats.failed_connects += 1
+                time.sleep(0.1)
+                continue
+            if not first_connect:
+                stats.reconnected()
+            first_connect = False
+        try:
+            google_mqtt.publish("%f" % time.monotonic())
+            stats.published += 1
+        except OSError:
+            continue
+        google_mqtt.loop()
+        next_publish += interval
+        time.sleep(max(next_publish - time.monotonic(), 0))
+
+def main():
+    parser = argparse.ArgumentParser(description="adafruit_iotcore load test")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=10, help="Publishes per second per client")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds")
+    parser.add_argument("--jwt-ttl", type=int, default=3600, help="JWT lifetime in seconds")
+    parser.add_argument("--events-quota", type=float, default=100, help="Per-device events/s")
+    args = parser.parse_args()
+
+    broker = IoT_Core_Stand_In(args.events_quota, 1)
+    broker.run()
+    stats = Load_Stats()
+    start = time.monotonic()
+    end = start + args.duration
+    threads = [threading.Thread(target=run_device, args=(i, broker.port, args, stats, end))
+               for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    broker.shutdown()
+
+    print("clients:            {}".format(args.clients))
+    print("published:          {}".format(stats.published))
+    print("received:           {} ({:.0f}/s)".format(broker.received, broker.received / elapsed))
+    print("latency p50/p99:    {:.2f} / {:.2f} ms".format(
+        percentile(broker.latencies, 0.5) * 1000, percentile(broker.latencies, 0.99) * 1000))
+    print("connects:           {} ({} rejected)".format(len(broker.connects), broker.rejected))
+    print("disconnects:        {} expired, {} over quota, {} bad topic".format(
+        broker.timeouts, broker.disconnects["quota"], broker.disconnects["topic"]))
+    print("reconnects:         {} (peak {}/s)".format(
+        len(stats.reconnects), stats.peak_reconnects()))
+    print("failed connects:    {}".format(stats.failed_connects))
+
+if __name__ == "__main__":
+    main()
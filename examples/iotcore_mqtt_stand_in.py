@@ -0,0 +1,58 @@
+# In-memory stand-in for a MiniMQTT client, shared by the examples which run
+# MQTT_API without a network connection. Runs on CPython and on CircuitPython,
+# copy it to the board alongside the example using it.
+
+# A well-formed, unsigned JWT for MQTT_API's validation
+TEST_JWT = (
+    "eyJ0eXAiOiAiSldUIiwgImFsZyI6ICJSUzI1NiJ9.eyJhdWQiOiAiYmVuY2htYXJrIn0=.c2ln"
+)
+
+class Null_Socket:
+    """Socket stand-in, discarding everything sent."""
+
+    def send(self, data): # pylint: disable=no-self-use
+        return len(data)
+
+class Null_MQTT:
+    """MiniMQTT stand-in counting published messages, and recording them and
+    subscriptions unless record is False. Binary payloads, which MQTT_API writes
+    to the client's socket, are discarded by its Null_Socket.
+
+    :param str device_id: Device, registry and project of the client id.
+    :param bool record: Records messages and subscriptions, pass False for
+        benchmarks so that nothing is allocated per message.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, device_id="test", record=True):
+        self._user = "unused"
+        self._pass = TEST_JWT
+        self._keep_alive = 60
+        self._logger = None
+        self._client_id = "projects/{0}/locations/us-central1/registries/{0}/devices/{0}".format(
+            device_id)
+        self._sock = Null_Socket()
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.messages = 0
+        self.published = [] if record else None
+        self.subscribed = [] if record else None
+
+    # pylint: disable=not-callable
+    def connect(self):
+        if self.on_connect is not None:
+            self.on_connect(self, None, 0, 0)
+
+    def loop(self):
+        pass
+
+    # pylint: disable=unused-argument
+    def publish(self, topic, msg, retain=False, qos=0):
+        self.messages += 1
+        if self.published is not None:
+            self.published.append((topic, msg))
+
+    def subscribe(self, topic, qos=0):
+        if self.subscribed is not None:
+            self.subscribed.append(topic)
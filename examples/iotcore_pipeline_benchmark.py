@@ -0,0 +1,50 @@
+import argparse
+import asyncio
+import time
+
+from iotcore_broker_stand_in import Broker_Stand_In
+from adafruit_iotcore_async import AsyncMQTT_API
+
+# Compares QoS 1 publish throughput of AsyncMQTT_API with different in-flight
+# windows, against a local broker stand-in which delays each PUBACK by a
+# simulated round-trip time. Runs on CPython.
+#
+#     python3 iotcore_pipeline_benchmark.py --rtt 0.1 --messages 200
+
+CLIENT_ID = "projects/bench/locations/us-central1/registries/bench/devices/bench"
+
+# A well-formed, unsigned JWT, not checked by the stand-in
+BENCHMARK_JWT = (
+    "eyJ0eXAiOiAiSldUIiwgImFsZyI6ICJSUzI1NiJ9.eyJhdWQiOiAiYmVuY2htYXJrIn0=.c2ln"
+)
+
+async def run(window, messages, port):
+    """Returns the QoS 1 messages per second published through a window."""
+    async def transport(host, port):
+        return await asyncio.open_connection(host, port)
+    google_mqtt = AsyncMQTT_API(CLIENT_ID, BENCHMARK_JWT, "127.0.0.1", port, transport)
+    google_mqtt.max_inflight = window
+    await google_mqtt.connect()
+    start = time.monotonic()
+    acks = [await google_mqtt.publish("reading %d" % i, qos=1, wait=False)
+            for i in range(messages)]
+    await asyncio.gather(*acks)
+    elapsed = time.monotonic() - start
+    await google_mqtt.disconnect()
+    return messages / elapsed
+
+async def main():
+    parser = argparse.ArgumentParser(description="AsyncMQTT_API QoS 1 pipelining benchmark")
+    parser.add_argument("--rtt", type=float, default=0.05, help="Simulated round trip, seconds")
+    parser.add_argument("--messages", type=int, default=200, help="Messages per window size")
+    args = parser.parse_args()
+
+    broker = Broker_Stand_In(ack_delay=args.rtt)
+    await broker.start()
+    for window in (1, 4, 16, 64):
+        rate = await run(window, args.messages, broker.port)
+        print("window {:>3}: {:>10.1f} messages/s ({:.1f} per round trip)".format(
+            window, rate, rate * args.rtt))
+    await broker.stop()
+
+asyncio.run(main()) # pylint: disable=no-member
@@ -0,0 +1,86 @@
+from iotcore_mqtt_stand_in import Null_MQTT
+from adafruit_iotcore import MQTT_API
+from adafruit_iotcore_queue import Outbox, Rate_Limiter, Token_Bucket
+
+# Checks Token_Bucket and Rate_Limiter against a fake clock, so the burst and
+# sustained rates are counted exactly rather than timed. Runs on CPython and
+# on CircuitPython, and raises AssertionError on the first failed check.
+#
+#     python3 iotcore_rate_limit_test.py
+
+class Fake_Clock:
+    """Clock for Token_Bucket which only moves when advanced."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+def takes(bucket, clock, seconds, step):
+    """Returns how many tokens are taken by trying every step seconds for seconds."""
+    taken = 0
+    for _ in range(int(round(seconds / step))):
+        clock.advance(step)
+        if bucket.take():
+            taken += 1
+    return taken
+
+def test_burst():
+    clock = Fake_Clock()
+    bucket = Token_Bucket(2, burst=5, clock=clock)
+    taken = sum(1 for _ in range(10) if bucket.take())
+    assert taken == 5, taken
+    assert bucket.wait_time == 0.5, bucket.wait_time
+    # An idle bucket refills to burst, and no further
+    clock.advance(60)
+    taken = sum(1 for _ in range(10) if bucket.take())
+    assert taken == 5, taken
+
+def test_sustained():
+    clock = Fake_Clock()
+    bucket = Token_Bucket(2, burst=5, clock=clock)
+    for _ in range(5):
+        bucket.take()
+    # Trying 10 times a second for 30 seconds, only the rate gets through
+    taken = takes(bucket, clock, 30, 0.1)
+    assert taken == 60, taken
+
+def test_publish_limited():
+    clock = Fake_Clock()
+    google_mqtt = MQTT_API(Null_MQTT(), validate=False)
+    google_mqtt.connect()
+    google_mqtt.rate_limiter = Rate_Limiter(events=Token_Bucket(10, burst=3, clock=clock))
+    sent = [google_mqtt.publish(i) for i in range(5)]
+    assert sent == [True, True, True, False, False], sent
+    assert google_mqtt.rate_limiter.limited == 2
+    # With an outbox, limited messages are queued and sent once tokens accrue
+    google_mqtt.outbox = Outbox(size=4)
+    assert google_mqtt.publish("queued")
+    assert len(google_mqtt.outbox) == 1
+    clock.advance(1)
+    google_mqtt.loop()
+    assert not google_mqtt.outbox
+    assert google_mqtt._client.published[-1][1] == "queued" # pylint: disable=protected-access
+
+def test_state_limited():
+    clock = Fake_Clock()
+    google_mqtt = MQTT_API(Null_MQTT(), validate=False)
+    google_mqtt.connect()
+    state = Token_Bucket(1, burst=1, clock=clock)
+    state.take()
+    google_mqtt.rate_limiter = Rate_Limiter(state=state)
+    # The first state is held back, and sent by loop once a token accrues
+    assert not google_mqtt.publish_state("booted")
+    google_mqtt.loop()
+    clock.advance(1)
+    google_mqtt.loop()
+    published = google_mqtt._client.published # pylint: disable=protected-access
+    assert published == [("/devices/test/state", "booted")], published
+
+for test in (test_burst, test_sustained, test_publish_limited, test_state_limited):
+    test()
+    print(test.__name__, "passed")
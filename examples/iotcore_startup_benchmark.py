@@ -0,0 +1,72 @@
+import gc
+import sys
+import time
+
+try:
+    import tracemalloc
+    # Traced from the start, so that the import below is measured in full
+    tracemalloc.start()
+except ImportError:
+    # MicroPython and CircuitPython, measured with gc.mem_alloc
+    tracemalloc = None
+
+from iotcore_mqtt_stand_in import Null_MQTT
+
+# Measures the time and heap used to import adafruit_iotcore and to construct
+# MQTT_API, with and without validation, for devices waking from deep sleep.
+# The first import is what is measured, so run this in a fresh interpreter or
+# straight after resetting the board.
+
+# Number of MQTT_API objects constructed for each measurement
+ROUNDS = 50
+
+# Libraries which adafruit_iotcore imports only when they are first used
+DEPENDENCIES = ("rtc", "asyncio", "adafruit_logging", "adafruit_jwt", "adafruit_rsa")
+
+def ticks_us():
+    """Returns the monotonic clock in microseconds."""
+    if hasattr(time, "monotonic_ns"):
+        return time.monotonic_ns() // 1000 # pylint: disable=no-member
+    return int(time.monotonic() * 1000000)
+
+def heap_used():
+    """Returns the bytes of heap in use."""
+    if tracemalloc is not None:
+        return tracemalloc.get_traced_memory()[0]
+    return gc.mem_alloc() # pylint: disable=no-member
+
+gc.collect()
+start_heap = heap_used()
+import_start = ticks_us()
+from adafruit_iotcore import MQTT_API # pylint: disable=wrong-import-position
+import_time = ticks_us() - import_start
+import_heap = heap_used() - start_heap
+
+def construct(validate):
+    """Prints the time and heap used to construct MQTT_API."""
+    clients = [Null_MQTT("bench", record=False) for _ in range(ROUNDS)]
+    gc.collect()
+    before = heap_used()
+    start = ticks_us()
+    objects = [MQTT_API(client, validate=validate) for client in clients]
+    elapsed = ticks_us() - start
+    used = heap_used() - before
+    print("{:<32}{:>10.0f} us{:>10.0f} bytes".format(
+        "MQTT_API(validate={})".format(validate), elapsed / ROUNDS, used / ROUNDS))
+    return objects
+
+print("{:<32}{:>10.0f} us{:>10.0f} bytes".format(
+    "import adafruit_iotcore", import_time, import_heap))
+print("imported dependencies:", [name for name in DEPENDENCIES if name in sys.modules])
+
+wake_start = ticks_us()
+google_mqtt = MQTT_API(Null_MQTT("bench", record=False), validate=False)
+google_mqtt.connect()
+google_mqtt.publish("awake")
+print("{:<32}{:>10.0f} us".format("construct to first publish", ticks_us() - wake_start))
+
+construct(False)
+try:
+    construct(True)
+except ImportError:
+    print("MQTT_API(validate=True) needs adafruit_jwt")
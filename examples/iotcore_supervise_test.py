@@ -0,0 +1,86 @@
+from iotcore_mqtt_stand_in import Null_MQTT
+from adafruit_iotcore import Backoff, MQTT_API
+from adafruit_iotcore_queue import Outbox
+
+# Checks MQTT_API.supervise against a MiniMQTT stand-in which fails with the
+# RuntimeErrors raised by ESP32SPI's sockets, such as for a failed DNS lookup
+# or connection. Runs on CPython and on CircuitPython, and raises
+# AssertionError on the first failed check.
+#
+#     python3 iotcore_supervise_test.py
+
+class Flaky_MQTT(Null_MQTT):
+    """MiniMQTT stand-in raising queued errors from connect, loop and publish."""
+
+    def __init__(self):
+        super().__init__()
+        self.connect_errors = []
+        self.loop_errors = []
+        self.publish_errors = []
+
+    def connect(self):
+        if self.connect_errors:
+            raise self.connect_errors.pop(0)
+        super().connect()
+
+    def loop(self):
+        if self.loop_errors:
+            raise self.loop_errors.pop(0)
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        if self.publish_errors:
+            raise self.publish_errors.pop(0)
+        super().publish(topic, msg, retain, qos)
+
+def supervised_client():
+    """Returns an MQTT_API and its Flaky_MQTT, retrying without a delay."""
+    client = Flaky_MQTT()
+    google_mqtt = MQTT_API(client, validate=False)
+    google_mqtt.backoff = Backoff(initial=0, jitter=0)
+    return google_mqtt, client
+
+def test_connect_failures():
+    google_mqtt, client = supervised_client()
+    client.connect_errors = [RuntimeError("Failed to request hostname"),
+                             RuntimeError("Failed to connect to host")]
+    assert not google_mqtt.supervise()
+    assert not google_mqtt.supervise()
+    assert google_mqtt.supervise()
+    assert google_mqtt.is_connected
+    assert google_mqtt.reconnect_failures == 2, google_mqtt.reconnect_failures
+    assert google_mqtt.reconnects == 1, google_mqtt.reconnects
+
+def test_lost_while_connected():
+    google_mqtt, client = supervised_client()
+    google_mqtt.connect()
+    google_mqtt.subscribe_to_config()
+    client.loop_errors = [RuntimeError("Timed out waiting for SPI char")]
+    assert not google_mqtt.supervise()
+    assert not google_mqtt.is_connected
+    # Reconnecting subscribes again
+    assert google_mqtt.supervise()
+    assert client.subscribed == ["/devices/test/config"] * 2, client.subscribed
+    # A failed send marks the client disconnected and queues the message
+    google_mqtt.outbox = Outbox(size=4)
+    client.publish_errors = [RuntimeError("Failed to send 12 bytes (sent 0)")]
+    assert google_mqtt.publish("queued")
+    assert not google_mqtt.is_connected
+    assert google_mqtt.supervise()
+    google_mqtt.loop()
+    assert client.published == [("/devices/test/events", "queued")], client.published
+
+def test_other_errors_raised():
+    google_mqtt, client = supervised_client()
+    google_mqtt.connect()
+    client.loop_errors = [RuntimeError("Unexpected handler result")]
+    try:
+        google_mqtt.supervise()
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("supervise swallowed an unrelated RuntimeError")
+    assert google_mqtt.is_connected
+
+for test in (test_connect_failures, test_lost_while_connected, test_other_errors_raised):
+    test()
+    print(test.__name__, "passed")
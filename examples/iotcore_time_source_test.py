@@ -0,0 +1,162 @@
+import http.server
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import types
+
+from adafruit_iotcore_http import HTTP_Session
+from adafruit_iotcore_time import (HTTP_Date_Time_Source, SNTP_Time_Source, Strftime_Time_Source,
+                                   Time_Sync, NTP_TO_UNIX_EPOCH)
+
+# Checks the time sources against local stand-ins for an NTP server, an HTTP
+# server's Date header and Adafruit IO's strftime time service. Runs on
+# CPython, and raises AssertionError on the first failed check.
+#
+#     python3 iotcore_time_source_test.py
+
+# Sun, 06 Nov 1994 08:49:37 GMT, in seconds since the Unix epoch
+TEST_TIME = 784111777
+TEST_DATE = "Sun, 06 Nov 1994 08:49:37 GMT"
+
+# The time service's local time for TEST_TIME in New York, which is 5 hours behind UTC
+TEST_STRFTIME = "1994-11-06 03:49:37.000 310 7 -0500 EST"
+
+class NTP_Stand_In:
+    """Answers NTP requests with TEST_TIME, or with a kiss-o'-death once kiss is set."""
+
+    def __init__(self):
+        self.kiss = False
+        self.requests = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            request, address = self.sock.recvfrom(48)
+            self.requests += 1
+            # Leap indicator 0, version 3, server mode, stratum 2
+            reply = bytearray(48)
+            reply[0] = request[0] & 0x38 | 0x04
+            reply[1] = 0 if self.kiss else 2
+            struct.pack_into("!I", reply, 40, TEST_TIME + NTP_TO_UNIX_EPOCH)
+            self.sock.sendto(reply, address)
+
+class HTTP_Stand_In(http.server.BaseHTTPRequestHandler):
+    """Serves TEST_DATE as the Date header, and TEST_STRFTIME from /strftime."""
+
+    protocol_version = "HTTP/1.1"
+    # Query strings of the requests to /strftime
+    queries = []
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        body = b""
+        if path == "/strftime":
+            self.queries.append(query)
+            body = TEST_STRFTIME.encode("utf-8")
+        if path == "/no-date":
+            self.send_response_only(200)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def date_time_string(self, timestamp=None):
+        return TEST_DATE
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+class Threading_HTTP_Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTP server handling each connection, which HTTP_Session keeps alive, on a thread."""
+
+    daemon_threads = True
+
+class Local_Network:
+    """Network backend sending requests for the time service to the local stand-in."""
+
+    def __init__(self, port):
+        self.session = HTTP_Session(timeout=5)
+        self.port = port
+
+    def get(self, url, headers=None):
+        query = url.partition("?")[2]
+        return self.session.get("http://127.0.0.1:{}/strftime?{}".format(self.port, query),
+                                headers=headers)
+
+def test_sntp(ntp):
+    source = SNTP_Time_Source(socket, "127.0.0.1", ntp.port, timeout=2)
+    assert source.get_time() == TEST_TIME, source.get_time()
+    ntp.kiss = True
+    try:
+        source.get_time()
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("kiss-o'-death reply accepted")
+    ntp.kiss = False
+
+def test_http_date(port):
+    session = HTTP_Session(timeout=5)
+    source = HTTP_Date_Time_Source(session, "http://127.0.0.1:{}/".format(port))
+    assert source.get_time() == TEST_TIME, source.get_time()
+    # The second request reuses the connection
+    assert source.get_time() == TEST_TIME
+    assert session.connections == 1, session.connections
+    try:
+        HTTP_Date_Time_Source(session, "http://127.0.0.1:{}/no-date".format(port)).get_time()
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("response without a Date header accepted")
+    session.close()
+
+def test_strftime(port):
+    # Sets a stand-in rtc module, as on a board
+    board_rtc = types.SimpleNamespace(datetime=None)
+    sys.modules["rtc"] = types.SimpleNamespace(RTC=lambda: board_rtc)
+    secrets = {"aio_username": "test", "aio_key": "key", "timezone": "America/New_York"}
+    network = Local_Network(port)
+    source = Strftime_Time_Source(network, secrets)
+    try:
+        assert source.get_time() == TEST_TIME, source.get_time()
+    finally:
+        del sys.modules["rtc"]
+        network.session.close()
+    query = HTTP_Stand_In.queries[-1]
+    assert "x-aio-key=key" in query and "tz=America/New_York" in query, query
+    # The board's clock is set to the local time
+    assert tuple(board_rtc.datetime[:6]) == (1994, 11, 6, 3, 49, 37), board_rtc.datetime
+
+def test_time_sync(ntp):
+    time_sync = Time_Sync(SNTP_Time_Source(socket, "127.0.0.1", ntp.port, timeout=2))
+    requests = ntp.requests
+    now = time_sync.time()
+    assert TEST_TIME <= now <= TEST_TIME + 1, now
+    # The monotonic clock is used until drift could exceed max_error
+    assert time_sync.time() - now <= 1
+    assert ntp.requests == requests + 1, ntp.requests
+    assert not time_sync.needs_sync
+
+def main():
+    ntp = NTP_Stand_In()
+    server = Threading_HTTP_Server(("127.0.0.1", 0), HTTP_Stand_In)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    test_sntp(ntp)
+    print("test_sntp passed")
+    test_http_date(port)
+    print("test_http_date passed")
+    test_strftime(port)
+    print("test_strftime passed")
+    test_time_sync(ntp)
+    print("test_time_sync passed")
+    server.shutdown()
+    server.server_close()
+
+main()
@@ -60,5 +60,7 @@ setup(
     # simple. Or you can use find_packages().
     # TODO: IF LIBRARY FILES ARE A PACKAGE FOLDER,
     #       CHANGE `py_modules=['...']` TO `packages=['...']`
-    py_modules=['adafruit_iotcore'],
+    py_modules=['adafruit_iotcore', 'adafruit_iotcore_async', 'adafruit_iotcore_codec',
+                'adafruit_iotcore_http', 'adafruit_iotcore_packet', 'adafruit_iotcore_queue',
+                'adafruit_iotcore_routing', 'adafruit_iotcore_telemetry', 'adafruit_iotcore_time'],
 )